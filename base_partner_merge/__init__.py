@@ -1 +1,4 @@
 import base_partner_merge
+import merge_job
+import merge_queue
+import merge_journal
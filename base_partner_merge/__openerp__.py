@@ -10,6 +10,7 @@
     'data': [
         'security/ir.model.access.csv',
         'base_partner_merge_view.xml',
+        'base_partner_merge_data.xml',
     ],
     'installable': True,
 }
@@ -1,68 +1,116 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
-from email.utils import parseaddr
-import functools
-import htmlentitydefs
 import itertools
+import json
 import logging
 import operator
 import re
-from ast import literal_eval
+import sys
 from openerp.tools import mute_logger
 
-# Validation Library https://pypi.python.org/pypi/validate_email/1.1
-from .validate_email import validate_email
+from .email_tools import (html_entity_decode, html_entity_decode_char,
+                          sanitize_email, sanitize_emails)
+from .merge_journal import add_int_array_column
+from .merge_stats import MergeStats
+from .merge_plan import MergePlan
+from .schema_catalogue import SchemaCatalogue
+from .disjoint_set import DisjointSet
+from .hierarchy import break_cycles, has_cycle
+from .fuzzy import (BLOCKING_KEYS, NAME_ORDER_SQL, FuzzyMatcher,
+                    blocking_key_sql, normalize_name)
 
 import openerp
 from openerp.osv import osv, orm
 from openerp.osv import fields
-from openerp.osv.orm import browse_record
 from openerp.tools.translate import _
 
-pattern = re.compile("&(\w+?);")
-
 _logger = logging.getLogger('base.partner.merge')
+# one JSON record per merge, see MergeStats.to_dict
+_stats_logger = logging.getLogger('base.partner.merge.stats')
 
 
-# http://www.php2python.com/wiki/function.html-entity-decode/
-def html_entity_decode_char(m, defs=htmlentitydefs.entitydefs):
-    try:
-        return defs[m.group(1)]
-    except KeyError:
-        return m.group(0)
-
-
-def html_entity_decode(string):
-    return pattern.sub(html_entity_decode_char, string)
+def is_integer_list(ids):
+    return all(isinstance(i, (int, long)) for i in ids)
 
 
-def sanitize_email(partner_email):
-    assert isinstance(partner_email, basestring) and partner_email
+def partner_id_of(value):
+    """Return the partner id of a many2one or ``res.partner,id`` value"""
+    if isinstance(value, basestring):
+        return int(value.split(',')[1])
+    return value
 
-    result = re.subn(r';|/|:', ',',
-                     html_entity_decode(partner_email or ''))[0].split(',')
 
-    emails = [parseaddr(email)[1]
-              for item in result
-              for email in item.split()]
+def normalize_vat(vat):
+    return re.sub(r'[\W_]+', '', vat or '', flags=re.UNICODE).upper()
 
-    return [email.lower()
-            for email in emails
-            if validate_email(email)]
 
+class ResPartner(osv.Model):
+    _inherit = 'res.partner'
 
-def is_integer_list(ids):
-    return all(isinstance(i, (int, long)) for i in ids)
+    def _get_merge_keys(self, cr, uid, ids, field_names, arg, context=None):
+        res = {}
+        for partner in self.read(cr, uid, ids, ['name', 'email', 'vat'],
+                                 context=context):
+            emails = sanitize_email(partner['email']) \
+                if partner['email'] else []
+            res[partner['id']] = {
+                'merge_name_key': normalize_name(partner['name']) or False,
+                'merge_email_key': emails[0] if emails else False,
+                'merge_vat_key': normalize_vat(partner['vat']) or False,
+            }
+        return res
 
+    # fields the normalized merge keys are computed from
+    _merge_key_fields = ['name', 'email', 'vat']
 
-class ResPartner(osv.Model):
-    _inherit = 'res.partner'
+    _merge_keys_store = {
+        'res.partner': (lambda self, cr, uid, ids, context=None: ids,
+                        _merge_key_fields, 10),
+    }
 
     _columns = {
         'id': fields.integer('Id', readonly=True),
         'create_date': fields.datetime('Create Date', readonly=True),
+        'merge_name_key': fields.function(
+            _get_merge_keys, type='char', string='Normalized Name',
+            multi='merge_keys', store=_merge_keys_store, select=True),
+        'merge_email_key': fields.function(
+            _get_merge_keys, type='char', string='Normalized Email',
+            multi='merge_keys', store=_merge_keys_store, select=True),
+        'merge_vat_key': fields.function(
+            _get_merge_keys, type='char', string='Normalized VAT',
+            multi='merge_keys', store=_merge_keys_store, select=True),
     }
 
+    def _auto_init(self, cr, context=None):
+        res = super(ResPartner, self)._auto_init(cr, context=context)
+        # email domain of the contacts, used by auto_set_parent_id and the
+        # similarity search
+        cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                   ('res_partner_merge_email_domain_index',))
+        if not cr.fetchone():
+            cr.execute('CREATE INDEX res_partner_merge_email_domain_index '
+                       'ON res_partner (%s)'
+                       % blocking_key_sql('email_domain'))
+        return res
+
+    def create(self, cr, uid, vals, context=None):
+        partner_id = super(ResPartner, self).create(cr, uid, vals,
+                                                    context=context)
+        self.pool['base.partner.merge.queue'].enqueue(cr, uid, [partner_id],
+                                                      context=context)
+        return partner_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(ResPartner, self).write(cr, uid, ids, vals,
+                                            context=context)
+        if set(vals).intersection(self._merge_key_fields):
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool['base.partner.merge.queue'].enqueue(cr, uid, ids,
+                                                          context=context)
+        return res
+
 
 class MergePartnerLine(osv.TransientModel):
     _name = 'base.partner.merge.line'
@@ -72,10 +120,17 @@ class MergePartnerLine(osv.TransientModel):
                                      'Wizard'),
         'min_id': fields.integer('MinID'),
         'aggr_ids': fields.char('Ids', required=True),
+        # destination ranked when the line was created
+        'dst_id': fields.integer('Destination'),
     }
 
     _order = 'min_id asc'
 
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerLine, self)._auto_init(cr, context=context)
+        add_int_array_column(cr, self._table, 'member_ids')
+        return res
+
 
 class MergePartnerAutomatic(osv.TransientModel):
     """
@@ -93,8 +148,33 @@ class MergePartnerAutomatic(osv.TransientModel):
         'group_by_is_company': fields.boolean('Is Company'),
         'group_by_vat': fields.boolean('VAT'),
         'group_by_parent_id': fields.boolean('Parent Company'),
+        'group_by_merge_name_key': fields.boolean('Normalized Name'),
+        'group_by_merge_email_key': fields.boolean('Normalized Email'),
+        'group_by_merge_vat_key': fields.boolean('Normalized VAT'),
+
+        # Similarity search
+        'match_mode': fields.selection([('exact', 'Identical Values'),
+                                        ('fuzzy', 'Similar Names')],
+                                       'Search Duplicates With',
+                                       required=True),
+        'block_by_name': fields.boolean('Name Prefix'),
+        'block_by_email_domain': fields.boolean('Email Domain'),
+        'block_by_zip': fields.boolean('Zip'),
+        'block_by_vat_country': fields.boolean('VAT Country'),
+        'fuzzy_method': fields.selection([('jaro_winkler', 'Jaro-Winkler'),
+                                          ('trigram', 'Trigrams')],
+                                         'Similarity', required=True),
+        'fuzzy_threshold': fields.float(
+            'Minimum Similarity',
+            help="Score between 0 and 1 above which two names are "
+                 "considered as duplicates."),
+        'fuzzy_window': fields.integer(
+            'Comparison Window',
+            help="Number of neighbours, sorted by name within a block, each "
+                 "contact is compared to."),
 
         'state': fields.selection([('option', 'Option'),
+                                   ('plan', 'Plan'),
                                    ('selection', 'Selection'),
                                    ('finished', 'Finished')],
                                   'State',
@@ -113,6 +193,18 @@ class MergePartnerAutomatic(osv.TransientModel):
         'exclude_journal_item': fields.boolean('Journal Items associated'
                                                ' to the contact'),
         'maximum_group': fields.integer("Maximum of Group of Contacts"),
+        'job_id': fields.many2one('base.partner.merge.job',
+                                  'Deduplication Job', readonly=True),
+        'merge_workers': fields.integer(
+            "Parallel Merges",
+            help="Number of groups of contacts merged concurrently by the "
+                 "automatic merge, each one in its own transaction."),
+        'plan_report': fields.text('Merge Plan', readonly=True),
+        'review_job_id': fields.many2one('base.partner.merge.job',
+                                         'Reviewed Job', readonly=True),
+        'review_group_id': fields.many2one('base.partner.merge.job.group',
+                                           'Reviewed Group', readonly=True),
+        'review_summary': fields.text('Contacts', readonly=True),
     }
 
     def default_get(self, cr, uid, fields, context=None):
@@ -125,14 +217,40 @@ class MergePartnerAutomatic(osv.TransientModel):
             partner_ids = context['active_ids']
             res['state'] = 'selection'
             res['partner_ids'] = partner_ids
-            res['dst_partner_id'] = self._get_ordered_partner(cr, uid,
-                                                              partner_ids,
-                                                              context=context
-                                                              )[-1].id
+            res['dst_partner_id'] = self._rank_partners(cr,
+                                                        [partner_ids])[0][0]
         return res
 
+    # number of candidate groups fetched and written at once
+    _candidate_chunk_size = 1000
+
+    # cost in seconds of a merge used by the plan when no job has been run
+    _plan_group_cost = 0.5
+    _plan_row_cost = 0.001
+
+    # groups of a reviewed job claimed and summarized ahead of the one shown
+    _review_prefetch = 5
+
+    # signals of _get_destination_signals ranking the destination of a merge
+    # when the parameter base_partner_merge.destination_ranking is not set
+    _destination_ranking = 'inactive,oldest'
+
+    # (model, partner field, wizard flag): the partners used in the model are
+    # left out of the candidate groups when the flag is checked, or always
+    # when the flag is None. Modules may add their own models.
+    _exclusion_models = [
+        ('res.users', 'partner_id', 'exclude_contact'),
+        ('account.move.line', 'partner_id', 'exclude_journal_item'),
+    ]
+
     _defaults = {
-        'state': 'option'
+        'state': 'option',
+        'merge_workers': 1,
+        'match_mode': 'exact',
+        'block_by_name': True,
+        'fuzzy_method': 'jaro_winkler',
+        'fuzzy_threshold': 0.92,
+        'fuzzy_window': 10,
     }
 
     def get_fk_on(self, cr, table):
@@ -154,6 +272,108 @@ class MergePartnerAutomatic(osv.TransientModel):
         """
         return cr.execute(q, (table,))
 
+    def _register_hook(self, cr):
+        # the registry is reloaded when modules are installed or upgraded,
+        # drop the schema catalogue so it is read again on the next merge
+        self._schema_catalogue = None
+        return super(MergePartnerAutomatic, self)._register_hook(cr)
+
+    def _get_schema_catalogue(self, cr):
+        """
+        Return the foreign keys, columns and unique keys around res_partner,
+        read from the pg_catalog once per registry.
+        """
+        catalogue = getattr(self, '_schema_catalogue', None)
+        if catalogue is None:
+            catalogue = self._schema_catalogue = SchemaCatalogue(cr)
+        return catalogue
+
+    def _get_referencing_edges(self, cr, edges, partner_ids):
+        """
+        Return the ``(table, column)`` edges having at least one row pointing
+        at ``partner_ids``, probing every edge in a single statement where
+        the ids are passed once, as an array.
+        """
+        if not edges or not partner_ids:
+            return []
+        query = ' UNION ALL '.join(
+            'SELECT %d WHERE EXISTS (SELECT 1 FROM "%s" '
+            'WHERE "%s" = ANY(%%(ids)s))' % (index, table, column)
+            for index, (table, column) in enumerate(edges))
+        cr.execute(query, {'ids': list(partner_ids)})
+        used = set(index for index, in cr.fetchall())
+        return [edge for index, edge in enumerate(edges) if index in used]
+
+    def _update_column(self, cr, table, column, dst_value, src_values,
+                       where=None, params=None, stats=None):
+        """
+        Point every row of ``table`` whose ``column`` is in ``src_values`` to
+        ``dst_value`` in a single statement and return the number of rows
+        rewritten. ``where`` is an extra SQL condition on the ``___tu`` alias.
+        The ids of the rows rewritten and the source each of them pointed to
+        are kept in ``stats``.
+
+        When ``column`` belongs to a unique key, rows that would collide with
+        an existing destination row are left untouched, as are all but one
+        source row per key.
+        """
+        catalogue = self._get_schema_catalogue(cr)
+        values = catalogue.unique_key_for(table, column)
+        has_id = 'id' in catalogue.columns.get(table, ())
+        query_dic = {
+            'table': table,
+            'column': column,
+            'where': ' AND %s' % where if where else '',
+            'from': ' FROM "%s" as ___old' % table if has_id else '',
+            'old': '___old.id = ___tu.id AND ' if has_id else '',
+            'returning': ('RETURNING ___tu.id, ___old."%s"' % column
+                          if has_id else ''),
+        }
+        if values:
+            query_dic.update({
+                'same_tw': ' AND '.join('___tu."%s" = ___tw."%s"'
+                                        % (value, value)
+                                        for value in values),
+                'same_tx': ' AND '.join('___tu."%s" = ___tx."%s"'
+                                        % (value, value)
+                                        for value in values),
+            })
+            query = """
+                UPDATE "%(table)s" as ___tu
+                SET "%(column)s" = %%(dst)s%(from)s
+                WHERE
+                    %(old)s___tu."%(column)s" IN %%(src)s AND
+                    NOT EXISTS (
+                        SELECT 1
+                        FROM "%(table)s" as ___tw
+                        WHERE
+                            ___tw."%(column)s" = %%(dst)s AND
+                            %(same_tw)s
+                    ) AND
+                    ___tu."%(column)s" = (
+                        SELECT min(___tx."%(column)s")
+                        FROM "%(table)s" as ___tx
+                        WHERE
+                            ___tx."%(column)s" IN %%(src)s AND
+                            %(same_tx)s
+                    )%(where)s
+                %(returning)s""" % query_dic
+        else:
+            query = """
+                UPDATE "%(table)s" as ___tu
+                SET "%(column)s" = %%(dst)s%(from)s
+                WHERE
+                    %(old)s___tu."%(column)s" IN %%(src)s%(where)s
+                %(returning)s""" % query_dic
+        cr.execute(query, dict(params or {}, dst=dst_value,
+                               src=tuple(src_values)))
+        rowcount = cr.rowcount
+        if stats is not None:
+            ids = [(id, partner_id_of(old)) for id, old in cr.fetchall()] \
+                if has_id else None
+            stats.add(table, column, rowcount, ids=ids)
+        return rowcount
+
     def _update_foreign_keys(self, cr, uid, src_partners,
                              dst_partner, context=None):
         _logger.debug('_update_foreign_keys for dst_partner: %s for '
@@ -161,75 +381,108 @@ class MergePartnerAutomatic(osv.TransientModel):
                       dst_partner.id,
                       list(map(operator.attrgetter('id'), src_partners)))
 
+        stats = (context or {}).get('merge_stats') or MergeStats()
+
         # find the many2one relation to a partner
         proxy = self.pool.get('res.partner')
-        self.get_fk_on(cr, 'res_partner')
-
-        # ignore two tables
-
-        for table, column in cr.fetchall():
-            if 'base_partner_merge_' in table:
-                continue
-            partner_ids = tuple(map(int, src_partners))
-
-            query = ("SELECT column_name FROM information_schema.columns"
-                     "  WHERE table_name LIKE '%s'") % (table)
-            cr.execute(query, ())
-            columns = []
-            for data in cr.fetchall():
-                if data[0] != column:
-                    columns.append(data[0])
-
-            query_dic = {
-                'table': table,
-                'column': column,
-                'value': columns[0],
-            }
-            if len(columns) <= 1:
-                # unique key treated
-                query = """
-                    UPDATE "%(table)s" as ___tu
-                    SET %(column)s = %%s
-                    WHERE
-                        %(column)s = %%s AND
-                        NOT EXISTS (
-                            SELECT 1
-                            FROM "%(table)s" as ___tw
-                            WHERE
-                                %(column)s = %%s AND
-                                ___tu.%(value)s = ___tw.%(value)s
-                        )""" % query_dic
-                for partner_id in partner_ids:
-                    cr.execute(query, (dst_partner.id, partner_id,
-                                       dst_partner.id))
+        catalogue = self._get_schema_catalogue(cr)
+
+        # ignore the tables of the wizard itself; the tables are always
+        # rewritten in the same order so that concurrent merges do not lock
+        # them in opposite orders
+        edges = sorted((table, column) for table, column in catalogue.fk_edges
+                       if 'base_partner_merge_' not in table)
+        partner_ids = tuple(map(int, src_partners))
+
+        edges = self._get_referencing_edges(cr, edges, partner_ids)
+        stats.statements += 1
+
+        for table, column in edges:
+            if catalogue.unique_key_for(table, column):
+                # unique key treated: rows colliding with the destination
+                # stay on the source and are dropped with it
+                self._update_column(cr, table, column, dst_partner.id,
+                                    partner_ids, stats=stats)
             else:
                 cr.execute("SAVEPOINT recursive_partner_savepoint")
                 try:
-                    query = ('UPDATE "%(table)s" SET %(column)s = %%s WHERE '
-                             '%(column)s IN %%s') % query_dic
-                    cr.execute(query, (dst_partner.id, partner_ids,))
+                    if 'id' in catalogue.columns.get(table, ()):
+                        # the old value is read from the joined row
+                        query = ('UPDATE "%(table)s" as ___tu '
+                                 'SET "%(column)s" = %%s '
+                                 'FROM "%(table)s" as ___old '
+                                 'WHERE ___old.id = ___tu.id '
+                                 'AND ___tu."%(column)s" IN %%s '
+                                 'RETURNING ___tu.id, ___old."%(column)s"'
+                                 % {'table': table, 'column': column})
+                        cr.execute(query, (dst_partner.id, partner_ids,))
+                        ids = cr.fetchall()
+                    else:
+                        query = ('UPDATE "%s" SET "%s" = %%s '
+                                 'WHERE "%s" IN %%s') % (table, column,
+                                                         column)
+                        cr.execute(query, (dst_partner.id, partner_ids,))
+                        ids = None
+                    rowcount = cr.rowcount
+                    statements = 3
 
                     if (column == proxy._parent_name
                             and table == 'res_partner'):
-                        query = """
-                            WITH RECURSIVE cycle(id, parent_id) AS (
-                                    SELECT id, parent_id FROM res_partner
-                                UNION
-                                    SELECT cycle.id, res_partner.parent_id
-                                    FROM   res_partner, cycle
-                                    WHERE  res_partner.id = cycle.parent_id
-                                      AND  cycle.id != cycle.parent_id
-                            )
-                            SELECT id FROM cycle
-                                WHERE id = parent_id AND id = %s
-                        """
-                        cr.execute(query, (dst_partner.id,))
-                        if cr.fetchall():
+                        statements += 1
+                        if has_cycle(cr, dst_partner.id, table, column):
                             cr.execute("ROLLBACK TO SAVEPOINT "
                                        "recursive_partner_savepoint")
-                finally:
-                    cr.execute("RELEASE SAVEPOINT "
-                               "recursive_partner_savepoint")
+                            statements += 1
+                            rowcount = 0
+                except Exception:
+                    # a lock timeout or a deadlock aborts the transaction:
+                    # the original error must reach the caller, which may
+                    # retry the merge
+                    exc_info = sys.exc_info()
+                    try:
+                        cr.execute("ROLLBACK TO SAVEPOINT "
+                                   "recursive_partner_savepoint")
+                    except Exception:
+                        _logger.debug('rollback to savepoint failed',
+                                      exc_info=True)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                cr.execute("RELEASE SAVEPOINT recursive_partner_savepoint")
+                stats.add(table, column, rowcount, statements=statements,
+                          ids=ids)
+
+        return stats
+
+    def _get_reference_models(self):
+        """
+        Return the ``(model, field_model, field_id)`` triplets of the models
+        linking to a partner through a model name and a record id.
+        """
+        return [
+            ('base.calendar', 'model_id.model', 'res_id'),
+            ('ir.attachment', 'res_model', 'res_id'),
+            ('mail.followers', 'res_model', 'res_id'),
+            ('mail.message', 'model', 'res_id'),
+            ('marketing.campaign.workitem', 'object_id.model', 'res_id'),
+            ('ir.model.data', 'model', 'res_id'),
+        ]
+
+    def _is_plain_column(self, cr, proxy, *field_names):
+        """
+        Check that ``field_names`` are regular stored columns of ``proxy``
+        which no stored function field depends on, so they can be rewritten
+        in SQL without bypassing any recomputation.
+        """
+        for field_name in field_names:
+            column = proxy._columns.get(field_name)
+            if (column is None or isinstance(column, fields.function)
+                    or not column._classic_write):
+                return False
+        for trigger in self.pool._store_function.get(proxy._name, []):
+            trigger_fields = trigger[3]
+            if (trigger_fields is None
+                    or set(field_names).intersection(trigger_fields)):
+                return False
+        return True
 
     def _update_reference_fields(self, cr, uid, src_partners, dst_partner,
                                  context=None):
@@ -238,64 +491,136 @@ class MergePartnerAutomatic(osv.TransientModel):
                       dst_partner.id,
                       list(map(operator.attrgetter('id'), src_partners)))
 
-        def update_records(model, src, field_model='model', field_id='res_id',
-                           context=None):
+        stats = (context or {}).get('merge_stats') or MergeStats()
+        src_ids = [partner.id for partner in src_partners]
+
+        for model, field_model, field_id in self._get_reference_models():
             proxy = self.pool.get(model)
             if proxy is None:
-                return
+                continue
+            if ('.' not in field_model
+                    and self._is_plain_column(cr, proxy,
+                                              field_model, field_id)):
+                self._update_column(cr, proxy._table, field_id,
+                                    dst_partner.id, src_ids,
+                                    where='___tu."%s" = %%(model)s'
+                                    % field_model,
+                                    params={'model': 'res.partner'},
+                                    stats=stats)
+                continue
             domain = [(field_model, '=', 'res.partner'),
-                      (field_id, '=', src.id)]
+                      (field_id, 'in', src_ids)]
             ids = proxy.search(cr, openerp.SUPERUSER_ID,
                                domain, context=context)
-            return proxy.write(cr, openerp.SUPERUSER_ID, ids,
-                               {field_id: dst_partner.id}, context=context)
-
-        update_records = functools.partial(update_records, context=context)
-
-        for partner in src_partners:
-            update_records('base.calendar', src=partner,
-                           field_model='model_id.model')
-            update_records('ir.attachment', src=partner,
-                           field_model='res_model')
-            update_records('mail.followers', src=partner,
-                           field_model='res_model')
-            update_records('mail.message', src=partner)
-            update_records('marketing.campaign.workitem', src=partner,
-                           field_model='object_id.model')
-            update_records('ir.model.data', src=partner)
+            rows = [(record['id'], record[field_id])
+                    for record in proxy.read(cr, openerp.SUPERUSER_ID, ids,
+                                             [field_id], context=context)]
+            if ids:
+                proxy.write(cr, openerp.SUPERUSER_ID, ids,
+                            {field_id: dst_partner.id}, context=context)
+            stats.add(proxy._table, field_id, len(ids),
+                      statements=3 if ids else 1, ids=rows)
 
         proxy = self.pool['ir.model.fields']
         domain = [('ttype', '=', 'reference')]
         record_ids = proxy.search(cr, openerp.SUPERUSER_ID, domain,
                                   context=context)
-
-        for record in proxy.browse(cr, openerp.SUPERUSER_ID, record_ids,
-                                   context=context):
-            try:
-                proxy_model = self.pool[record.model]
-            except KeyError:
+        records = sorted(proxy.read(cr, openerp.SUPERUSER_ID, record_ids,
+                                    ['model', 'name'], context=context),
+                         key=operator.itemgetter('model', 'name'))
+
+        src_refs = ['res.partner,%d' % partner_id for partner_id in src_ids]
+        dst_ref = 'res.partner,%d' % dst_partner.id
+        for record in records:
+            proxy_model = self.pool.get(record['model'])
+            if proxy_model is None:
                 # ignore old tables
                 continue
 
-            if record.model == 'ir.property':
+            if record['model'] == 'ir.property':
                 continue
 
-            field_type = proxy_model._columns.get(record.name).__class__._type
+            column = proxy_model._columns.get(record['name'])
+            if column is None or isinstance(column, fields.function):
+                continue
 
-            if field_type == 'function':
+            if self._is_plain_column(cr, proxy_model, record['name']):
+                self._update_column(cr, proxy_model._table, record['name'],
+                                    dst_ref, src_refs, stats=stats)
                 continue
 
-            for partner in src_partners:
-                domain = [
-                    (record.name, '=', 'res.partner,%d' % partner.id)
-                ]
-                model_ids = proxy_model.search(cr, openerp.SUPERUSER_ID,
-                                               domain, context=context)
-                values = {
-                    record.name: 'res.partner,%d' % dst_partner.id,
-                }
-                proxy_model.write(cr, openerp.SUPERUSER_ID, model_ids, values,
-                                  context=context)
+            domain = [(record['name'], 'in', src_refs)]
+            model_ids = proxy_model.search(cr, openerp.SUPERUSER_ID,
+                                           domain, context=context)
+            rows = [(row['id'], partner_id_of(row[record['name']]))
+                    for row in proxy_model.read(cr, openerp.SUPERUSER_ID,
+                                                model_ids, [record['name']],
+                                                context=context)]
+            if model_ids:
+                proxy_model.write(cr, openerp.SUPERUSER_ID, model_ids,
+                                  {record['name']: dst_ref}, context=context)
+            stats.add(proxy_model._table, record['name'], len(model_ids),
+                      statements=3 if model_ids else 1, ids=rows)
+
+        return stats
+
+    # strategy merging the values of a field, as ``{field: strategy}`` with
+    # the method ``_merge_value_<strategy>``; other fields use 'last'
+    _merge_value_strategies = {}
+
+    def _get_merge_value_fields(self, cr):
+        """
+        Return the fields of res.partner whose values are merged: the
+        columns stored as such, which excludes the x2many and function
+        fields.
+        """
+        proxy = self.pool['res.partner']
+        return sorted(
+            name for name, column in proxy._columns.iteritems()
+            if column._type not in ('many2many', 'one2many')
+            and not isinstance(column, fields.function)
+            and column._classic_write)
+
+    def _merge_value_last(self, cr, uid, field, values, context=None):
+        """Keep the last value set, the destination coming last"""
+        result = False
+        for value in values:
+            if value:
+                result = value
+        return result
+
+    def _merge_value_concat(self, cr, uid, field, values, context=None):
+        """Join the distinct texts set, the destination coming last"""
+        texts = []
+        for value in values:
+            if value and value not in texts:
+                texts.append(value)
+        return '\n\n'.join(texts) or False
+
+    def _get_merged_values(self, cr, uid, partner_ids, context=None):
+        """
+        Return the values of the partner ``partner_ids[-1]`` (the destination)
+        once merged with the others, read in a single query. Only the fields
+        whose merged value differs from the current one are returned.
+        """
+        field_names = self._get_merge_value_fields(cr)
+        cr.execute('SELECT id, %s FROM res_partner WHERE id IN %%s'
+                   % ', '.join('"%s"' % name for name in field_names),
+                   (tuple(partner_ids),))
+        rows = dict((row[0], row[1:]) for row in cr.fetchall())
+        records = [rows[partner_id] for partner_id in partner_ids
+                   if partner_id in rows]
+        dst_values = rows[partner_ids[-1]]
+
+        result = {}
+        for index, name in enumerate(field_names):
+            strategy = self._merge_value_strategies.get(name, 'last')
+            value = getattr(self, '_merge_value_%s' % strategy)(
+                cr, uid, name, [record[index] for record in records],
+                context=context)
+            if value != (dst_values[index] or False):
+                result[name] = value
+        return result
 
     def _update_values(self, cr, uid, src_partners, dst_partner, context=None):
         _logger.debug('_update_values for dst_partner: %s for src_partners: '
@@ -303,26 +628,17 @@ class MergePartnerAutomatic(osv.TransientModel):
                       dst_partner.id,
                       list(map(operator.attrgetter('id'), src_partners)))
 
-        columns = dst_partner._columns
+        partner_ids = [partner.id for partner in src_partners]
+        values = self._get_merged_values(cr, uid,
+                                         partner_ids + [dst_partner.id],
+                                         context=context)
+        stats = (context or {}).get('merge_stats')
+        if stats is not None:
+            stats.statements += 1
 
-        def write_serializer(column, item):
-            if isinstance(item, browse_record):
-                return item.id
-            else:
-                return item
-
-        values = dict()
-        for column, field in columns.iteritems():
-            if (field._type not in ('many2many', 'one2many')
-                    and not isinstance(field, fields.function)):
-                for item in itertools.chain(src_partners, [dst_partner]):
-                    if item[column]:
-                        values[column] = write_serializer(column,
-                                                          item[column])
-
-        values.pop('id', None)
         parent_id = values.pop('parent_id', None)
-        dst_partner.write(values)
+        if values:
+            dst_partner.write(values)
         if parent_id and parent_id != dst_partner.id:
             try:
                 dst_partner.write({'parent_id': parent_id})
@@ -331,6 +647,98 @@ class MergePartnerAutomatic(osv.TransientModel):
                              'parent_id %s of partner: %s',
                              parent_id, dst_partner.id)
 
+    def _check_merge_groups(self, cr, uid, groups, context=None):
+        """
+        Evaluate the safety rules of ``_merge`` for ``groups``, a list of
+        ``(dst_id, src_ids)``, with a single query for all of them: at most
+        ``base_partner_merge.max_partners`` contacts and, unless ``uid`` is
+        the Administrator, the same email for all the contacts and no
+        journal items on the sources. Return the error message of each
+        group, ``None`` when it can be merged.
+        """
+        errors = [None] * len(groups)
+        max_partners = self._get_max_partners(cr)
+        if max_partners:
+            for index, (dst_id, src_ids) in enumerate(groups):
+                if len(src_ids) + 1 > max_partners:
+                    errors[index] = _(
+                        "For safety reasons, you cannot merge more than %d "
+                        "contacts together. You can re-open the wizard "
+                        "several times if needed.") % max_partners
+        if openerp.SUPERUSER_ID == uid:
+            return errors
+
+        indexes, partner_ids, sources = [], [], []
+        for index, (dst_id, src_ids) in enumerate(groups):
+            if errors[index] is None:
+                for partner_id in [dst_id] + list(src_ids):
+                    indexes.append(index)
+                    partner_ids.append(partner_id)
+                    sources.append(partner_id != dst_id)
+        if not indexes:
+            return errors
+
+        move_line_obj = self.pool.get('account.move.line')
+        journal_items = 'false'
+        if move_line_obj is not None:
+            journal_items = ('EXISTS (SELECT 1 FROM "%s" WHERE partner_id = '
+                             'g.partner_id)' % move_line_obj._table)
+        # a NULL email counts as one more email, as in a set of the values
+        cr.execute("""  SELECT g.group_index,
+                               count(DISTINCT p.email)
+                               + max(CASE WHEN p.email IS NULL
+                                          THEN 1 ELSE 0 END),
+                               bool_or(g.source AND %s)
+                          FROM (SELECT unnest(%%s::int[]) as group_index,
+                                       unnest(%%s::int[]) as partner_id,
+                                       unnest(%%s::boolean[]) as source)
+                               as g
+                          JOIN res_partner as p ON p.id = g.partner_id
+                      GROUP BY g.group_index
+                   """ % journal_items, (indexes, partner_ids, sources))
+        for index, emails, has_journal_items in cr.fetchall():
+            if emails > 1:
+                errors[index] = _(
+                    "All contacts must have the same email. Only the "
+                    "Administrator can merge contacts with different emails.")
+            elif has_journal_items:
+                errors[index] = _(
+                    "Only the destination contact may be linked to existing "
+                    "Journal Items. Please ask the Administrator if you need "
+                    "to merge several contacts linked to existing Journal "
+                    "Items.")
+        return errors
+
+    def _get_max_partners(self, cr):
+        """
+        Return the maximum number of contacts merged together, set by the
+        system parameter ``base_partner_merge.max_partners`` (0 for no
+        limit).
+        """
+        value = self.pool['ir.config_parameter'].get_param(
+            cr, openerp.SUPERUSER_ID, 'base_partner_merge.max_partners')
+        return int(value) if value else 3
+
+    def _format_merge_stats(self, stats):
+        """Return the rows rewritten per table by a merge, as html"""
+        if not stats.rows:
+            return ''
+        tables = {}
+        for (table, column), count in stats.rows.iteritems():
+            tables[table] = tables.get(table, 0) + count
+        return '<ul>%s</ul>' % ''.join(
+            '<li>%s: %d</li>' % (table, count)
+            for table, count in sorted(tables.iteritems()))
+
+    def _lock_partners(self, cr, partner_ids):
+        """
+        Lock the partners of a group, by increasing id, before rewriting
+        anything: a merge conflicting with another transaction then waits
+        on its first statement instead of deadlocking halfway.
+        """
+        cr.execute("SELECT id FROM res_partner WHERE id IN %s "
+                   "ORDER BY id FOR UPDATE", (tuple(partner_ids),))
+
     @mute_logger('openerp.osv.expression', 'openerp.osv.orm')
     def _merge(self, cr, uid, partner_ids, dst_partner=None, context=None):
         proxy = self.pool.get('res.partner')
@@ -340,22 +748,6 @@ class MergePartnerAutomatic(osv.TransientModel):
         if len(partner_ids) < 2:
             return
 
-        if len(partner_ids) > 3:
-            raise osv.except_osv(
-                _('Error'),
-                _("For safety reasons, you cannot merge more than 3 contacts "
-                  "together. You can re-open the wizard several times if "
-                  "needed."))
-
-        if (openerp.SUPERUSER_ID != uid
-                and len(set(partner.email for partner
-                            in proxy.browse(cr, uid, partner_ids,
-                                            context=context))) > 1):
-            raise osv.except_osv(
-                _('Error'),
-                _("All contacts must have the same email. Only the "
-                  "Administrator can merge contacts with different emails."))
-
         if dst_partner and dst_partner.id in partner_ids:
             src_partners = proxy.browse(cr, uid,
                                         [id for id in partner_ids
@@ -367,98 +759,142 @@ class MergePartnerAutomatic(osv.TransientModel):
             dst_partner = ordered_partners[-1]
             src_partners = ordered_partners[:-1]
         _logger.info("dst_partner: %s", dst_partner.id)
+        src_ids = [partner.id for partner in src_partners]
 
-        if (openerp.SUPERUSER_ID != uid
-                and self._model_is_installed(cr, uid, 'account.move.line',
-                                             context=context)
-                and self.pool.get('account.move.line'
-                                  ).search(cr, openerp.SUPERUSER_ID,
-                                           [('partner_id',
-                                             'in',
-                                             [partner.id for partner
-                                              in src_partners])],
-                                           context=context)):
-            raise osv.except_osv(
-                _('Error'),
-                _("Only the destination contact may be linked to existing "
-                  "Journal Items. Please ask the Administrator if you need to"
-                  " merge several contacts linked to existing Journal "
-                  "Items."))
-
-        call_it = lambda function: function(cr, uid, src_partners,
-                                            dst_partner, context=context)
-
-        call_it(self._update_foreign_keys)
-        call_it(self._update_reference_fields)
-        call_it(self._update_values)
+        error = self._check_merge_groups(cr, uid, [(dst_partner.id, src_ids)],
+                                         context=context)[0]
+        if error:
+            raise osv.except_osv(_('Error'), error)
 
-        _logger.info('(uid = %s) merged the partners %r with %s',
-                     uid,
-                     list(map(operator.attrgetter('id'), src_partners)),
-                     dst_partner.id)
-        dst_partner.message_post(
-            body='%s %s' % (
-                _("Merged with the following partners:"),
-                ", ".join('%s<%s>(ID %s)' % (p.name, p.email or 'n/a', p.id)
-                                             for p in src_partners)))
+        stats = (context or {}).get('merge_stats') or MergeStats()
+        with stats.phase('lock', cr):
+            self._lock_partners(cr, partner_ids)
 
-        for partner in src_partners:
-            partner.unlink()
+        journal_obj = self.pool['base.partner.merge.journal']
+        with stats.phase('snapshot', cr):
+            snapshot = journal_obj.snapshot(cr, uid,
+                                            src_ids + [dst_partner.id],
+                                            context=context)
 
-    def clean_emails(self, cr, uid, context=None):
+        merge_context = dict(context or {}, merge_stats=stats)
+        call_it = lambda function: function(cr, uid, src_partners,
+                                            dst_partner,
+                                            context=merge_context)
+
+        with stats.phase('update_foreign_keys', cr):
+            call_it(self._update_foreign_keys)
+        with stats.phase('update_reference_fields', cr):
+            call_it(self._update_reference_fields)
+        with stats.phase('update_values', cr):
+            call_it(self._update_values)
+
+        with stats.phase('message_post', cr):
+            dst_partner.message_post(
+                body='%s %s%s' % (
+                    _("Merged with the following partners:"),
+                    ", ".join('%s<%s>(ID %s)' % (p.name, p.email or 'n/a',
+                                                 p.id)
+                              for p in src_partners),
+                    self._format_merge_stats(stats)))
+
+        with stats.phase('journal', cr):
+            journal_obj.record(cr, uid, src_ids, dst_partner.id, stats,
+                               snapshot, context=context)
+
+        with stats.phase('unlink', cr):
+            proxy.unlink(cr, uid, src_ids, context=context)
+            stats.add('res_partner', 'id', len(src_ids), statements=0)
+
+        _logger.info('(uid = %s) merged the partners %r with %s: %s',
+                     uid, src_ids, dst_partner.id, stats.summary())
+        record = dict(stats.to_dict(), uid=uid, src_ids=src_ids,
+                      dst_id=dst_partner.id)
+        _stats_logger.info(json.dumps(record, sort_keys=True),
+                           extra={'merge_stats': record})
+        return stats
+
+    def clean_emails(self, cr, uid, context=None, chunk_size=None,
+                     progress_interval=10000):
         """
         Clean the email address of the partner, if there is an email field
         with a minimum of two addresses, the system will create a new partner,
         with the information of the previous one and will copy the new cleaned
         email into the email field.
+
+        Only the partners whose email is not already a single lower-case
+        plain address are read, by chunks of ``chunk_size``. Partners getting
+        the same cleaned email are written together and the progress is
+        logged every ``progress_interval`` partners. The extra addresses are
+        copied with ``copy``, so the overrides of ``copy``, ``copy_data`` and
+        ``create`` apply to the new partners. A chunk failing is rolled back
+        and skipped.
         """
-        if context is None:
-            context = {}
+        context = dict(context or {}, active_test=False)
 
         proxy_model = self.pool['ir.model.fields']
         field_ids = proxy_model.search(cr, uid,
                                        [('model', '=', 'res.partner'),
                                         ('ttype', 'like', '%2many')],
                                        context=context)
-        fields = proxy_model.read(cr, uid, field_ids, context=context)
+        fields = proxy_model.read(cr, uid, field_ids, ['name'],
+                                  context=context)
         reset_fields = dict((field['name'], []) for field in fields)
 
         proxy_partner = self.pool['res.partner']
-        context['active_test'] = False
-        ids = proxy_partner.search(cr, uid, [], context=context)
-
-        fields = ['name', 'var' 'partner_id' 'is_company', 'email']
-        partners = proxy_partner.read(cr, uid, ids, fields, context=context)
-
-        partners.sort(key=operator.itemgetter('id'))
-        partners_len = len(partners)
-
-        _logger.info('partner_len: %r', partners_len)
-
-        for idx, partner in enumerate(partners):
-            if not partner['email']:
-                continue
 
-            percent = (idx / float(partners_len)) * 100.0
-            _logger.info('idx: %r', idx)
-            _logger.info('percent: %r', percent)
+        # same expression as email_tools.simple_address, such addresses are
+        # left untouched by sanitize_email once lower-cased
+        where = ("email IS NOT NULL AND NOT ("
+                 "email = lower(email) AND "
+                 "email ~ '^[a-z0-9_%+-]+([.][a-z0-9_%+-]+)*"
+                 "@[a-z0-9-]+([.][a-z0-9-]+)+$')")
+        cr.execute("SELECT count(*) FROM res_partner WHERE %s" % where)
+        partners_len = cr.fetchone()[0]
+        _logger.info('clean_emails: %d partners to check', partners_len)
+
+        query = ("SELECT id, email FROM res_partner WHERE %s ORDER BY id"
+                 % where)
+        done = updated = created = 0
+        next_progress = progress_interval
+        for rows in self._iter_query_chunks(cr, query, size=chunk_size):
+            writes = {}
+            copies = []
+            for (partner_id, partner_email), emails in zip(
+                    rows, sanitize_emails([row[1] for row in rows])):
+                email = emails[0] if emails else False
+                if email != partner_email:
+                    writes.setdefault(email, []).append(partner_id)
+                copies.extend((partner_id, extra) for extra in emails[1:])
+
+            cr.execute('SAVEPOINT clean_emails_chunk')
             try:
-                emails = sanitize_email(partner['email'])
-                head, tail = emails[:1], emails[1:]
-                email = head[0] if head else False
-
-                proxy_partner.write(cr, uid, [partner['id']],
-                                    {'email': email}, context=context)
-
-                for email in tail:
-                    values = dict(reset_fields, email=email)
-                    proxy_partner.copy(cr, uid, partner['id'], values,
+                for email, partner_ids in writes.iteritems():
+                    proxy_partner.write(cr, uid, partner_ids,
+                                        {'email': email}, context=context)
+                for partner_id, email in copies:
+                    proxy_partner.copy(cr, uid, partner_id,
+                                       dict(reset_fields, email=email),
                                        context=context)
-
             except Exception:
-                _logger.exception("There is a problem with this partner: %r",
-                                  partner)
-                raise
+                cr.execute('ROLLBACK TO SAVEPOINT clean_emails_chunk')
+                _logger.exception("There is a problem with the partners: %r",
+                                  [row[0] for row in rows])
+            else:
+                cr.execute('RELEASE SAVEPOINT clean_emails_chunk')
+                updated += sum(len(partner_ids)
+                               for partner_ids in writes.itervalues())
+                created += len(copies)
+
+            done += len(rows)
+            if progress_interval and done >= next_progress:
+                next_progress = done + progress_interval
+                _logger.info('clean_emails: %d/%d partners (%.1f%%), '
+                             '%d updated, %d created', done, partners_len,
+                             done * 100.0 / (partners_len or 1),
+                             updated, created)
+
+        _logger.info('clean_emails: %d partners checked, %d updated, '
+                     '%d created', done, updated, created)
         return True
 
     def close_cb(self, cr, uid, ids, context=None):
@@ -469,7 +905,8 @@ class MergePartnerAutomatic(osv.TransientModel):
 
         filters = []
         for field in fields:
-            if field in ['email', 'name']:
+            if field in ['email', 'name', 'merge_name_key',
+                         'merge_email_key', 'merge_vat_key']:
                 filters.append((field, 'IS NOT', 'NULL'))
 
         criteria = ' AND '.join('%s %s %s' % (field, operator, value)
@@ -525,37 +962,104 @@ class MergePartnerAutomatic(osv.TransientModel):
         """
         context = dict(context or {}, active_test=False)
         this = self.browse(cr, uid, ids[0], context=context)
+        if this.review_group_id:
+            self._close_review_group(cr, uid, this, 'skipped',
+                                     context=context)
         if this.current_line_id:
             this.current_line_id.unlink()
         return self._next_screen(cr, uid, this, context)
 
+    def _get_destination_signals(self, cr):
+        """
+        Return the signals available to rank the partners of a group,
+        ``{name: ORDER BY term on the partner p}``, the destination of the
+        merge sorting first. Modules may override it to add their signals.
+        """
+        catalogue = self._get_schema_catalogue(cr)
+        documents = ' + '.join(
+            '(SELECT count(*) FROM "%s" WHERE "%s" = p.id)' % (table, column)
+            for table, column in sorted(catalogue.fk_edges)
+            if 'base_partner_merge_' not in table) or '0'
+        return {
+            'inactive': 'p.active ASC',
+            'active': 'p.active DESC',
+            'oldest': 'p.create_date ASC NULLS FIRST',
+            'recent_activity': ('coalesce(p.write_date, p.create_date) '
+                                'DESC NULLS LAST'),
+            'documents': '%s DESC' % documents,
+        }
+
+    def _get_destination_ranking(self, cr):
+        """
+        Return the ORDER BY terms of the signals listed by the system
+        parameter ``base_partner_merge.destination_ranking``, the partner
+        id breaking the ties.
+        """
+        value = self.pool['ir.config_parameter'].get_param(
+            cr, openerp.SUPERUSER_ID, 'base_partner_merge.destination_ranking')
+        names = [name.strip() for name
+                 in (value or self._destination_ranking).split(',')
+                 if name.strip()]
+        signals = self._get_destination_signals(cr)
+        unknown = [name for name in names if name not in signals]
+        if unknown:
+            raise osv.except_osv(
+                _('Error'),
+                _("Unknown signals to rank the destination contact: %s")
+                % ', '.join(unknown))
+        return [signals[name] for name in names] + ['p.id DESC']
+
+    def _rank_partners(self, cr, groups):
+        """
+        Return the partners of each of ``groups`` (lists of partner ids),
+        the destination of the merge first, ranked with one query for all
+        the groups. Missing partners are left out.
+        """
+        res = [[] for group in groups]
+        indexes, partner_ids = [], []
+        for index, group in enumerate(groups):
+            indexes.extend([index] * len(group))
+            partner_ids.extend(group)
+        if not partner_ids:
+            return res
+        cr.execute("""  SELECT g.group_index, p.id
+                          FROM (SELECT unnest(%%s::int[]) as group_index,
+                                       unnest(%%s::int[]) as partner_id)
+                               as g
+                          JOIN res_partner as p ON p.id = g.partner_id
+                      ORDER BY g.group_index, %s
+                   """ % ', '.join(self._get_destination_ranking(cr)),
+                   (indexes, partner_ids))
+        for index, partner_id in cr.fetchall():
+            res[index].append(partner_id)
+        return res
+
     def _get_ordered_partner(self, cr, uid, partner_ids, context=None):
-        partners = self.pool.get('res.partner'
-                                 ).browse(cr, uid,
-                                          list(partner_ids),
-                                          context=context)
-        ordered_partners = sorted(sorted(partners,
-                                         key=operator.attrgetter('create_date'),
-                                         reverse=True),
-                                  key=operator.attrgetter('active'),
-                                  reverse=True)
-        return ordered_partners
+        """Return the partners ``partner_ids``, the destination last"""
+        ranked = self._rank_partners(cr, [list(partner_ids)])[0]
+        return self.pool.get('res.partner').browse(cr, uid, ranked[::-1],
+                                                   context=context)
 
     def _next_screen(self, cr, uid, this, context=None):
-        this.refresh()
+        if this.review_job_id:
+            return self._next_review_screen(cr, uid, this, context=context)
+        cr.execute("""  SELECT id, member_ids, dst_id
+                          FROM base_partner_merge_line
+                         WHERE wizard_id = %s
+                      ORDER BY min_id
+                         LIMIT 1
+                   """, (this.id,))
+        row = cr.fetchone()
         values = {}
-        if this.line_ids:
+        if row:
             # in this case, we try to find the next record.
-            current_line = this.line_ids[0]
-            current_partner_ids = literal_eval(current_line.aggr_ids)
+            line_id, current_partner_ids, dst_id = row
             values.update({
-                'current_line_id': current_line.id,
+                'current_line_id': line_id,
                 'partner_ids': [(6, 0, current_partner_ids)],
-                'dst_partner_id': self._get_ordered_partner(
-                    cr, uid,
-                    current_partner_ids,
-                    context
-                    )[-1].id,
+                'dst_partner_id': (dst_id
+                                   or self._rank_partners(
+                                       cr, [current_partner_ids])[0][0]),
                 'state': 'selection',
             })
         else:
@@ -575,65 +1079,261 @@ class MergePartnerAutomatic(osv.TransientModel):
             'target': 'new',
         }
 
+    def _next_review_screen(self, cr, uid, this, context=None):
+        """
+        Show the next group of the reviewed job claimed by ``uid``. The
+        next ``_review_prefetch`` groups are claimed and summarized along
+        with it, so that the following screens only read their summary.
+        The context key ``partner_merge_no_prefetch`` disables this.
+        """
+        group_obj = self.pool['base.partner.merge.job.group']
+        prefetch = self._review_prefetch
+        if (context or {}).get('partner_merge_no_prefetch'):
+            prefetch = 0
+        values = {
+            'review_group_id': False,
+            'partner_ids': [(5, 0)],
+            'dst_partner_id': False,
+            'review_summary': False,
+            'state': 'finished',
+        }
+        while True:
+            groups = group_obj.claim(cr, uid, this.review_job_id.id,
+                                     limit=prefetch + 1, context=context)
+            if not groups:
+                break
+            summaries = self._summarize_review_groups(
+                cr, uid, [(group[0], group[1]) for group in groups
+                          if not group[3]],
+                context=context)
+            group_id, member_ids, dst_id, summary = groups[0]
+            partner_ids = self._rank_partners(cr, [member_ids])[0]
+            if len(partner_ids) < 2:
+                group_obj.write(cr, uid, [group_id], {
+                    'state': 'skipped',
+                    'date_done': fields.datetime.now(),
+                    'error': _("The contacts do not exist anymore."),
+                }, context=context)
+                continue
+            values.update({
+                'review_group_id': group_id,
+                'partner_ids': [(6, 0, partner_ids)],
+                'dst_partner_id': (dst_id if dst_id in partner_ids
+                                   else partner_ids[0]),
+                'review_summary': summaries.get(group_id, summary),
+                'state': 'selection',
+            })
+            break
+
+        this.write(values)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': this._name,
+            'res_id': this.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def _summarize_review_groups(self, cr, uid, groups, context=None):
+        """
+        Write and return ``{group_id: summary}``, the key figures of the
+        contacts of ``groups``, a list of ``(group_id, partner_ids)`` of the
+        job groups, read with one query per table for all the groups.
+        """
+        if not groups:
+            return {}
+        partner_ids = sorted(set(itertools.chain.from_iterable(
+            partner_ids for group_id, partner_ids in groups)))
+        cr.execute("SELECT id, name, email, active, create_date "
+                   "FROM res_partner WHERE id = ANY(%s)", (partner_ids,))
+        partners = dict((row[0], row[1:]) for row in cr.fetchall())
+        linked = {}
+        for partner_counts in self._count_references(
+                cr, uid, partner_ids, context=context).itervalues():
+            for partner_id, count in partner_counts.iteritems():
+                linked[partner_id] = linked.get(partner_id, 0) + count
+
+        summaries = {}
+        for group_id, partner_ids in groups:
+            lines = []
+            for partner_id in partner_ids:
+                if partner_id not in partners:
+                    continue
+                name, email, active, create_date = partners[partner_id]
+                lines.append(_('%s <%s> (ID %s)%s: created on %s, %d linked '
+                               'records') % (
+                    name, email or 'n/a', partner_id,
+                    '' if active else _(', archived'), create_date,
+                    linked.get(partner_id, 0)))
+            summaries[group_id] = '\n'.join(lines)
+        cr.execute("""  UPDATE base_partner_merge_job_group as g
+                           SET review_summary = s.summary
+                          FROM (SELECT unnest(%s::int[]) as id,
+                                       unnest(%s::text[]) as summary) as s
+                         WHERE g.id = s.id
+                   """, (summaries.keys(), summaries.values()))
+        return summaries
+
+    def _close_review_group(self, cr, uid, this, state, stats=None,
+                            context=None):
+        """Mark the reviewed group of ``this`` as ``state`` if it is still
+        claimed by ``uid``"""
+        group_obj = self.pool['base.partner.merge.job.group']
+        group_id = this.review_group_id.id
+        group_obj.check_claim(cr, uid, group_id, context=context)
+        values = {
+            'state': state,
+            'date_done': fields.datetime.now(),
+        }
+        if stats is not None:
+            stats = stats.to_dict()
+            values.update({
+                'duration': stats['time'],
+                'statement_count': stats['statements'],
+                'row_count': stats['rows'],
+                'stats': json.dumps(stats, sort_keys=True),
+            })
+        group_obj.write(cr, uid, [group_id], values, context=context)
+
     def _model_is_installed(self, cr, uid, model, context=None):
         proxy = self.pool.get('ir.model')
         domain = [('model', '=', model)]
         return proxy.search_count(cr, uid, domain, context=context) > 0
 
+    def _get_used_partners(self, cr, uid, partner_ids, models,
+                           context=None):
+        """
+        Return the set of the partners of ``partner_ids`` used in one of the
+        ``models``, a dict ``{model: partner field}``, read in one query.
+        """
+        if not partner_ids or not models:
+            return set()
+        query = ' UNION '.join(
+            'SELECT "%s" FROM "%s" WHERE "%s" = ANY(%%(ids)s)'
+            % (field, self.pool[model]._table, field)
+            for model, field in sorted(models.iteritems()))
+        cr.execute(query, {'ids': list(partner_ids)})
+        return set(partner_id for partner_id, in cr.fetchall())
+
     def _partner_use_in(self, cr, uid, aggr_ids, models, context=None):
         """
         Check if there is no occurence of this group of partner in the selected
         model
         """
-        for model, field in models.iteritems():
-            proxy = self.pool.get(model)
-            domain = [(field, 'in', aggr_ids)]
-            if proxy.search_count(cr, uid, domain, context=context):
-                return True
-        return False
+        return bool(self._get_used_partners(cr, uid, aggr_ids, models,
+                                            context=context))
+
+    def _filter_used_groups(self, cr, uid, groups, models, context=None):
+        """
+        Return the groups of partner ids ``groups`` having no partner used
+        in the ``models``, with a single query for all of them.
+        """
+        used = self._get_used_partners(
+            cr, uid, set(itertools.chain.from_iterable(groups)), models,
+            context=context)
+        if not used:
+            return list(groups)
+        return [group for group in groups if used.isdisjoint(group)]
+
+    def _get_exclusion_models(self, flags):
+        """
+        Return ``{model: partner field}``, the installed models of
+        ``_exclusion_models`` always excluded or whose flag is in ``flags``.
+        """
+        models = {}
+        for model, field, flag in self._exclusion_models:
+            if flag and flag not in flags:
+                continue
+            if self.pool.get(model) is not None:
+                models[model] = field
+        return models
 
     def compute_models(self, cr, uid, ids, context=None):
         """
         Compute the different models needed by the system if you want to
-        exclude some partners.
+        exclude some partners: the installed models of
+        ``_exclusion_models`` whose wizard flag is checked.
         """
         assert is_integer_list(ids)
 
         this = self.browse(cr, uid, ids[0], context=context)
+        return self._get_exclusion_models(set(
+            flag for model, field, flag in self._exclusion_models
+            if flag and this[flag]))
 
-        models = {}
-        if this.exclude_contact:
-            models['res.users'] = 'partner_id'
-
-        if (self._model_is_installed(cr, uid, 'account.move.line',
-                                     context=context)
-                and this.exclude_journal_item):
-            models['account.move.line'] = 'partner_id'
-
-        return models
+    def _exclude_partner_use_in(self, cr, uid, query, models, context=None):
+        """
+        Wrap the candidate ``query`` to drop the groups having a partner
+        used in one of the selected ``models``, as anti-joins evaluated by
+        the database instead of one ``search_count`` per group.
+        """
+        exclusions = [
+            'NOT EXISTS (SELECT 1 FROM "%s" WHERE "%s" = '
+            'ANY(___candidates.aggr_ids))' % (self.pool[model]._table, field)
+            for model, field in sorted(models.iteritems())
+        ]
+        if not exclusions:
+            return query
+        return ("SELECT ___candidates.min_id, ___candidates.aggr_ids "
+                "FROM (%s) AS ___candidates(min_id, aggr_ids) "
+                "WHERE %s ORDER BY ___candidates.min_id"
+                % (query, ' AND '.join(exclusions)))
+
+    def _iter_query_chunks(self, cr, query, params=None, size=None):
+        """
+        Execute ``query`` on a server-side cursor and yield its rows by
+        chunks of ``size``, so that large results are never loaded at once.
+        The named cursor shares the transaction of ``cr``.
+        """
+        size = size or self._candidate_chunk_size
+        cursor = cr._cnx.cursor('base_partner_merge_candidates')
+        try:
+            cursor.itersize = size
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def _create_merge_lines(self, cr, uid, wizard_id, rows):
+        """
+        Insert the ``(min_id, aggr_ids)`` candidate groups ``rows`` as lines
+        of the wizard ``wizard_id`` in a single statement, with the
+        destination of each group ranked by ``_rank_partners``.
+        """
+        if not rows:
+            return
+        ranked = self._rank_partners(cr, [list(aggr_ids)
+                                          for min_id, aggr_ids in rows])
+        query = ("INSERT INTO base_partner_merge_line "
+                 "(wizard_id, min_id, aggr_ids, member_ids, dst_id, "
+                 "create_uid, create_date, write_uid, write_date) VALUES %s"
+                 % ', '.join(["(%s, %s, %s, %s, %s, %s, "
+                              "now() at time zone 'UTC', "
+                              "%s, now() at time zone 'UTC')"] * len(rows)))
+        params = []
+        for (min_id, aggr_ids), partner_ids in zip(rows, ranked):
+            params.extend([wizard_id, min_id, str(list(aggr_ids)),
+                           list(aggr_ids),
+                           partner_ids[0] if partner_ids else None, uid, uid])
+        cr.execute(query, params)
 
     def _process_query(self, cr, uid, ids, query, context=None):
         """
         Execute the select request and write the result in this wizard
         """
-        proxy = self.pool.get('base.partner.merge.line')
         this = self.browse(cr, uid, ids[0], context=context)
         models = self.compute_models(cr, uid, ids, context=context)
-        cr.execute(query)
+        query = self._exclude_partner_use_in(cr, uid, query, models,
+                                             context=context)
 
         counter = 0
-        for min_id, aggr_ids in cr.fetchall():
-            if models and self._partner_use_in(cr, uid, aggr_ids, models,
-                                               context=context):
-                continue
-            values = {
-                'wizard_id': this.id,
-                'min_id': min_id,
-                'aggr_ids': aggr_ids,
-            }
-
-            proxy.create(cr, uid, values, context=context)
-            counter += 1
+        for rows in self._iter_query_chunks(cr, query):
+            self._create_merge_lines(cr, uid, this.id, rows)
+            counter += len(rows)
 
         values = {
             'state': 'selection',
@@ -644,6 +1344,78 @@ class MergePartnerAutomatic(osv.TransientModel):
 
         _logger.info("counter: %s", counter)
 
+    def _compute_selected_blocking(self, this):
+        block_by_str = 'block_by_'
+        keys = [
+            key
+            for key in BLOCKING_KEYS
+            if getattr(this, '%s%s' % (block_by_str, key), False)
+        ]
+
+        if not keys:
+            raise osv.except_osv(_('Error'),
+                                 _("You have to specify at least one "
+                                   "blocking key for the similarity search"))
+
+        return keys
+
+    def _generate_blocking_query(self, cr, uid, key, models, context=None):
+        """
+        Return the query listing ``(block, id, normalized name)`` of the
+        partners sorted by the blocking ``key`` and by name, without the
+        partners used in the excluded ``models``.
+        """
+        expression = blocking_key_sql(key)
+        criteria = [
+            'merge_name_key IS NOT NULL',
+            "coalesce(%s, '') != ''" % expression,
+        ]
+        criteria.extend(
+            'NOT EXISTS (SELECT 1 FROM "%s" WHERE "%s" = res_partner.id)'
+            % (self.pool[model]._table, field)
+            for model, field in sorted(models.iteritems()))
+        return ("SELECT %s, id, merge_name_key FROM res_partner WHERE %s "
+                "ORDER BY 1, %s, id"
+                % (expression, ' AND '.join(criteria), NAME_ORDER_SQL))
+
+    def _process_fuzzy(self, cr, uid, ids, context=None):
+        """
+        Search groups of partners with similar names and write them in this
+        wizard. Partners are only compared within the blocks of the selected
+        blocking keys, one streamed pass per key.
+        """
+        this = self.browse(cr, uid, ids[0], context=context)
+        keys = self._compute_selected_blocking(this)
+        models = self.compute_models(cr, uid, ids, context=context)
+
+        matcher = FuzzyMatcher(method=this.fuzzy_method,
+                               threshold=this.fuzzy_threshold,
+                               window=this.fuzzy_window)
+        for key in keys:
+            matcher.reset()
+            query = self._generate_blocking_query(cr, uid, key, models,
+                                                  context=context)
+            for rows in self._iter_query_chunks(cr, query):
+                matcher.feed(rows)
+
+        groups = matcher.groups(max_size=self._get_max_partners(cr))
+        if this.maximum_group:
+            groups = groups[:this.maximum_group]
+
+        size = self._candidate_chunk_size
+        for index in xrange(0, len(groups), size):
+            self._create_merge_lines(
+                cr, uid, this.id,
+                [(group[0], group) for group in groups[index:index + size]])
+
+        this.write({
+            'state': 'selection',
+            'number_group': len(groups),
+        })
+
+        _logger.info("counter: %s (%s comparisons)", len(groups),
+                     matcher.comparisons)
+
     def start_process_cb(self, cr, uid, ids, context=None):
         """
         Start the process.
@@ -655,23 +1427,255 @@ class MergePartnerAutomatic(osv.TransientModel):
 
         context = dict(context or {}, active_test=False)
         this = self.browse(cr, uid, ids[0], context=context)
-        groups = self._compute_selected_groupby(this)
-        query = self._generate_query(groups, this.maximum_group)
-        self._process_query(cr, uid, ids, query, context=context)
+        self._compute_candidates(cr, uid, this, context=context)
 
         return self._next_screen(cr, uid, this, context)
 
+    def _compute_candidates(self, cr, uid, this, context=None):
+        """
+        Write the candidate groups of the selected search in the lines of
+        the wizard ``this``.
+        """
+        if this.match_mode == 'fuzzy':
+            self._process_fuzzy(cr, uid, [this.id], context=context)
+        else:
+            groups = self._compute_selected_groupby(this)
+            query = self._generate_query(groups, this.maximum_group)
+            self._process_query(cr, uid, [this.id], query, context=context)
+
+    def _get_plan_destinations(self, cr, groups):
+        """
+        Return the ``(dst_id, src_ids)`` pairs ``_merge`` would pick for
+        ``groups``, read in one query, and the number of groups it would
+        refuse for having too many contacts.
+        """
+        max_partners = self._get_max_partners(cr)
+        pairs = []
+        skipped = 0
+        for partner_ids in self._rank_partners(cr, groups):
+            if len(partner_ids) < 2:
+                continue
+            if max_partners and len(partner_ids) > max_partners:
+                skipped += 1
+                continue
+            pairs.append((partner_ids[0], partner_ids[1:]))
+        return pairs, skipped
+
+    def _count_references(self, cr, uid, partner_ids, context=None):
+        """
+        Return ``{(table, column): {partner_id: rowcount}}``, the rows
+        ``_update_foreign_keys`` and ``_update_reference_fields`` would
+        rewrite when merging the source partners ``partner_ids``. Every
+        table is read with one grouped count, nothing is modified.
+        """
+        counts = {}
+        if not partner_ids:
+            return counts
+
+        def count(table, column, values, where='', params=()):
+            cr.execute('SELECT "%s", count(*) FROM "%s" '
+                       'WHERE "%s" = ANY(%%s)%s GROUP BY "%s"'
+                       % (column, table, column, where, column),
+                       (list(values),) + tuple(params))
+            for value, rowcount in cr.fetchall():
+                counts.setdefault((table, column), {})[values[value]] = \
+                    rowcount
+
+        catalogue = self._get_schema_catalogue(cr)
+        by_id = dict((partner_id, partner_id) for partner_id in partner_ids)
+        edges = [(table, column) for table, column in catalogue.fk_edges
+                 if 'base_partner_merge_' not in table]
+        for table, column in self._get_referencing_edges(cr, edges,
+                                                         partner_ids):
+            count(table, column, by_id)
+
+        for model, field_model, field_id in self._get_reference_models():
+            proxy = self.pool.get(model)
+            if proxy is None:
+                continue
+            columns = catalogue.columns.get(proxy._table, [])
+            if '.' not in field_model and field_model in columns:
+                count(proxy._table, field_id, by_id,
+                      ' AND "%s" = %%s' % field_model, ('res.partner',))
+                continue
+            ids = proxy.search(cr, openerp.SUPERUSER_ID,
+                               [(field_model, '=', 'res.partner'),
+                                (field_id, 'in', list(partner_ids))],
+                               context=context)
+            for record in proxy.read(cr, openerp.SUPERUSER_ID, ids,
+                                     [field_id], context=context):
+                rows = counts.setdefault((proxy._table, field_id), {})
+                rows[record[field_id]] = rows.get(record[field_id], 0) + 1
+
+        by_ref = dict(('res.partner,%d' % partner_id, partner_id)
+                      for partner_id in partner_ids)
+        proxy = self.pool['ir.model.fields']
+        record_ids = proxy.search(cr, openerp.SUPERUSER_ID,
+                                  [('ttype', '=', 'reference')],
+                                  context=context)
+        for record in proxy.read(cr, openerp.SUPERUSER_ID, record_ids,
+                                 ['model', 'name'], context=context):
+            proxy_model = self.pool.get(record['model'])
+            if proxy_model is None or record['model'] == 'ir.property':
+                continue
+            if record['name'] in catalogue.columns.get(proxy_model._table,
+                                                       []):
+                count(proxy_model._table, record['name'], by_ref)
+
+        return counts
+
+    def _plan_groups(self, cr, uid, groups, context=None):
+        """
+        Return a ``MergePlan`` estimating the rows rewritten by the merge of
+        ``groups`` (lists of partner ids), by chunks of groups. The groups
+        ``_merge`` would refuse to ``uid`` are only counted.
+        """
+        plan = MergePlan()
+        size = self._candidate_chunk_size
+        for index in xrange(0, len(groups), size):
+            pairs, skipped = self._get_plan_destinations(
+                cr, groups[index:index + size])
+            plan.skipped += skipped
+            errors = self._check_merge_groups(cr, uid, pairs,
+                                              context=context)
+            plan.refused += len(filter(None, errors))
+            pairs = [pair for pair, error in zip(pairs, errors)
+                     if not error]
+            src_ids = list(itertools.chain.from_iterable(
+                src_ids for dst_id, src_ids in pairs))
+            counts = self._count_references(cr, uid, src_ids,
+                                            context=context)
+            for dst_id, src_ids in pairs:
+                rows = {}
+                for key, partner_counts in counts.iteritems():
+                    rows[key] = sum(partner_counts.get(partner_id, 0)
+                                    for partner_id in src_ids)
+                # the destination is updated and the sources are deleted
+                rows[('res_partner', 'id')] = len(src_ids) + 1
+                plan.add_group(len(src_ids) + 1, rows)
+        return plan
+
+    def _get_plan_costs(self, cr):
+        """
+        Return the ``(group_cost, row_cost)`` in seconds used to estimate
+        the runtime: the mean duration of the groups already merged by the
+        jobs, or the defaults of the wizard on a fresh database.
+        """
+        cr.execute("SELECT avg(duration) FROM base_partner_merge_job_group "
+                   "WHERE state = 'done' AND duration > 0")
+        group_cost = cr.fetchone()[0]
+        if group_cost:
+            return group_cost, 0.0
+        return self._plan_group_cost, self._plan_row_cost
+
+    def plan_process_cb(self, cr, uid, ids, context=None):
+        """
+        Search the candidate groups like the automatic merge and report the
+        rows, tables and time it would take, without merging anything.
+        """
+        assert is_integer_list(ids)
+
+        context = dict(context or {}, active_test=False)
+        this = self.browse(cr, uid, ids[0], context=context)
+        self._compute_candidates(cr, uid, this, context=context)
+
+        cr.execute("SELECT member_ids FROM base_partner_merge_line "
+                   "WHERE wizard_id = %s ORDER BY min_id", (this.id,))
+        groups = [member_ids for member_ids, in cr.fetchall()]
+        cr.execute("DELETE FROM base_partner_merge_line WHERE wizard_id = %s",
+                   (this.id,))
+
+        plan = self._plan_groups(cr, uid, groups, context=context)
+        group_cost, row_cost = self._get_plan_costs(cr)
+        report = plan.report(plan.estimate_runtime(group_cost, row_cost,
+                                                   this.merge_workers))
+        _logger.info('merge plan:\n%s', report)
+
+        this.write({
+            'state': 'plan',
+            'number_group': len(groups),
+            'plan_report': report,
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': this._name,
+            'res_id': this.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def _partition_groups(self, cr, groups):
+        """
+        Split ``groups`` (lists of partner ids) into units which can be merged
+        concurrently, returned as lists of indexes in ``groups``. Groups
+        sharing a partner, or whose partners are referenced by the same row
+        of a table having several foreign keys to res_partner, end up in the
+        same unit. A child partner is rewritten by the group of its parent,
+        so the hierarchy of res_partner counts too.
+        """
+        clusters = DisjointSet()
+        owner = {}
+        for index, partner_ids in enumerate(groups):
+            clusters.find(index)
+            for partner_id in partner_ids:
+                if partner_id in owner:
+                    clusters.union(owner[partner_id], index)
+                else:
+                    owner[partner_id] = index
+
+        if len(groups) > 1:
+            table_columns = {}
+            for table, column in self._get_schema_catalogue(cr).fk_edges:
+                if 'base_partner_merge_' not in table:
+                    table_columns.setdefault(table, []).append(column)
+            for table, columns in sorted(table_columns.iteritems()):
+                if table == 'res_partner':
+                    selected = ['id'] + columns
+                elif len(columns) > 1:
+                    selected = columns
+                else:
+                    continue
+                query = 'SELECT %s FROM "%s" WHERE %s' % (
+                    ', '.join('"%s"' % column for column in selected),
+                    table,
+                    ' OR '.join('"%s" = ANY(%%(ids)s)' % column
+                                for column in columns))
+                cr.execute(query, {'ids': list(owner)})
+                for row in cr.fetchall():
+                    indexes = set(owner[partner_id] for partner_id in row
+                                  if partner_id in owner)
+                    if len(indexes) > 1:
+                        clusters.union(*indexes)
+
+        return [sorted(unit) for unit in sorted(clusters.groups(), key=min)]
+
+    def _run_merge_lines(self, cr, uid, this, name, context=None):
+        """
+        Move the candidate groups of the wizard into a persistent
+        deduplication job and run it.
+        """
+        job_obj = self.pool['base.partner.merge.job']
+        job_id = job_obj.create_from_wizard(cr, uid, this.id, name,
+                                            context=context)
+        line_obj = self.pool['base.partner.merge.line']
+        line_ids = line_obj.search(cr, uid, [('wizard_id', '=', this.id)],
+                                   context=context)
+        line_obj.unlink(cr, uid, line_ids, context=context)
+        this.write({'job_id': job_id})
+        job_obj.run(cr, uid, [job_id], context=context)
+        return job_id
+
     def automatic_process_cb(self, cr, uid, ids, context=None):
         assert is_integer_list(ids)
         this = self.browse(cr, uid, ids[0], context=context)
         this.start_process_cb()
-        this.refresh()
-
-        for line in this.line_ids:
-            partner_ids = literal_eval(line.aggr_ids)
-            self._merge(cr, uid, partner_ids, context=context)
-            line.unlink()
-            cr.commit()
+        if this.match_mode == 'fuzzy':
+            name = _('Merge similar names by %s') % ', '.join(
+                self._compute_selected_blocking(this))
+        else:
+            name = _('Merge by %s') % ', '.join(
+                self._compute_selected_groupby(this))
+        self._run_merge_lines(cr, uid, this, name, context=context)
 
         this.write({'state': 'finished'})
         return {
@@ -714,12 +1718,8 @@ class MergePartnerAutomatic(osv.TransientModel):
         """
 
         self._process_query(cr, uid, ids, query, context=context)
-
-        for line in this.line_ids:
-            partner_ids = literal_eval(line.aggr_ids)
-            self._merge(cr, uid, partner_ids, context=context)
-            line.unlink()
-            cr.commit()
+        self._run_merge_lines(cr, uid, this, _('Parent migration'),
+                              context=context)
 
         this.write({'state': 'finished'})
 
@@ -744,17 +1744,7 @@ class MergePartnerAutomatic(osv.TransientModel):
     def update_all_process_cb(self, cr, uid, ids, context=None):
         assert is_integer_list(ids)
 
-        # WITH RECURSIVE cycle(id, parent_id) AS (
-        #     SELECT id, parent_id FROM res_partner
-        #   UNION
-        #     SELECT  cycle.id, res_partner.parent_id
-        #     FROM    res_partner, cycle
-        #     WHERE   res_partner.id = cycle.parent_id AND
-        #             cycle.id != cycle.parent_id
-        # )
-        # UPDATE  res_partner
-        # SET     parent_id = NULL
-        # WHERE   id in (SELECT id FROM cycle WHERE id = parent_id);
+        break_cycles(cr)
 
         this = self.browse(cr, uid, ids[0], context=context)
 
@@ -837,61 +1827,95 @@ class MergePartnerAutomatic(osv.TransientModel):
                 'target': 'new',
             }
 
+        merge_context = context
+        if this.review_group_id:
+            self.pool['base.partner.merge.job.group'].check_claim(
+                cr, uid, this.review_group_id.id, context=context)
+            merge_context = dict(context, merge_stats=MergeStats())
         self._merge(cr, uid, partner_ids, this.dst_partner_id,
-                    context=context)
+                    context=merge_context)
 
+        if this.review_group_id:
+            self._close_review_group(cr, uid, this, 'done',
+                                     merge_context['merge_stats'],
+                                     context=context)
         if this.current_line_id:
             this.current_line_id.unlink()
 
         return self._next_screen(cr, uid, this, context)
 
+    # email domains shared by unrelated contacts, never used as a company
+    _auto_parent_excluded_domains = ['gmail.com']
+
     def auto_set_parent_id(self, cr, uid, ids, context=None):
+        """
+        Attach the contacts of each email domain to the graded partner of
+        the domain having the most open or paid invoices, unless other
+        partners of the domain have invoices too. All domains are computed
+        in one statement and applied with a single UPDATE, which returns
+        the ``(partner_id, old_parent_id, new_parent_id)`` of the rows
+        changed.
+        """
         assert is_integer_list(ids)
 
-        # select partner who have one least invoice
-        partner_treated = ['@gmail.com']
-        cr.execute("""  SELECT p.id, p.email
-                        FROM res_partner as p
-                        LEFT JOIN account_invoice as a
-                        ON p.id = a.partner_id AND a.state in ('open','paid')
-                        WHERE p.grade_id is NOT NULL
-                        GROUP BY p.id
-                        ORDER BY COUNT(a.id) DESC
-                """)
-        re_email = re.compile(r".*@")
-        for id, email in cr.fetchall():
-            # check email domain
-            email = re_email.sub("@", email or "")
-            if not email or email in partner_treated:
-                continue
-            partner_treated.append(email)
-
-            # don't update the partners if they are more of one who have
-            # invoice
-            cr.execute("""
-                SELECT *
-                    FROM res_partner as p
-                        WHERE p.id != %s AND p.email LIKE '%%%s' AND
-                           EXISTS (SELECT * FROM account_invoice as a
-                                   WHERE p.id = a.partner_id
-                                       AND a.state in ('open','paid'))
-                    """ % (id, email))
-
-            if len(cr.fetchall()) > 1:
-                _logger.info("%s MORE OF ONE COMPANY", email)
-                continue
-
-            # to display changed values
-            cr.execute("""  SELECT id,email
-                            FROM res_partner
-                            WHERE parent_id != %s
-                                AND id != %s AND email LIKE '%%%s'
-                    """ % (id, id, email))
-            _logger.info("%r", cr.fetchall())
-
-            # upgrade
-            cr.execute("""  UPDATE res_partner
-                            SET parent_id = %s
-                            WHERE id != %s AND email LIKE '%%%s'
-                    """ % (id, id, email))
-        return False
+        cr.execute("""
+            WITH candidate AS (
+                SELECT DISTINCT ON (%(p_domain)s)
+                       p.id, %(p_domain)s as domain
+                  FROM res_partner as p
+             LEFT JOIN account_invoice as a
+                    ON a.partner_id = p.id AND a.state IN ('open', 'paid')
+                 WHERE p.grade_id IS NOT NULL
+                   AND %(p_domain)s != ''
+                   AND %(p_domain)s NOT IN %%(excluded)s
+              GROUP BY p.id
+              ORDER BY %(p_domain)s, count(a.id) DESC, p.id
+            ), company AS (
+                -- domains with one partner with invoices at most besides
+                -- the candidate
+                SELECT c.id, c.domain
+                  FROM candidate as c
+                 WHERE (SELECT count(*)
+                          FROM res_partner as i
+                         WHERE %(i_domain)s = c.domain
+                           AND i.id != c.id
+                           AND EXISTS (SELECT 1
+                                         FROM account_invoice as a
+                                        WHERE a.partner_id = i.id
+                                          AND a.state IN ('open', 'paid'))
+                       ) <= 1
+            )
+            UPDATE res_partner as p
+               SET parent_id = company.id
+              FROM company, res_partner as old
+             WHERE %(p_domain)s = company.domain
+               AND old.id = p.id
+               AND p.id != company.id
+               AND p.parent_id IS DISTINCT FROM company.id
+               -- do not make the company a child of its own children
+               AND NOT EXISTS (SELECT 1
+                                 FROM res_partner as c
+                                WHERE c.id = company.id
+                                  AND c.parent_id = p.id)
+         RETURNING p.id, old.parent_id, p.parent_id
+        """ % {'p_domain': blocking_key_sql('email_domain', 'p'),
+               'i_domain': blocking_key_sql('email_domain', 'i')},
+            {'excluded': tuple(self._auto_parent_excluded_domains) or ('',)})
+        changes = cr.fetchall()
+
+        if changes:
+            # parent_id was written in SQL, recompute the stored fields
+            # depending on it
+            proxy = self.pool['res.partner']
+            partner_ids = [change[0] for change in changes]
+            for _order, model, model_ids, field_names in sorted(
+                    proxy._store_get_values(cr, uid, partner_ids,
+                                            ['parent_id'], context=context)):
+                self.pool[model]._store_set_values(cr, uid, model_ids,
+                                                   field_names,
+                                                   context=context)
+        _logger.info('auto_set_parent_id: %d contacts attached to %d '
+                     'companies', len(changes),
+                     len(set(change[2] for change in changes)))
+        _logger.debug('auto_set_parent_id: %r', changes)
+        return changes
@@ -0,0 +1,16 @@
+"""Helpers shared by the benchmarks, only using the standard library"""
+import imp
+import importlib
+import os
+import sys
+
+MODULE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load(name):
+    """Import a module of base_partner_merge without importing OpenERP"""
+    if 'partner_merge_bench' not in sys.modules:
+        package = imp.new_module('partner_merge_bench')
+        package.__path__ = [MODULE_PATH]
+        sys.modules['partner_merge_bench'] = package
+    return importlib.import_module('partner_merge_bench.%s' % name)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Benchmark of the cycle checks of the partner hierarchy on deep trees.
+
+    python benchmarks/bench_hierarchy.py [--chains 200] [--depth 50]
+                                         [--repeat 3] [--dsn DSN]
+
+Without ``--dsn`` only the in-memory part runs: the bulk detector
+``find_cycles_in`` against a closure of every node, which is what the
+previous ``WITH RECURSIVE cycle`` query computed. With ``--dsn`` (a libpq
+connection string, psycopg2 required) the hierarchy is loaded in a
+temporary table and both SQL checks of a merge are timed as well: the
+previous full-table CTE and the ancestor walk of ``has_cycle``.
+"""
+import argparse
+import timeit
+
+from bench_common import load
+
+LEGACY_QUERY = """
+    WITH RECURSIVE cycle(id, parent_id) AS (
+            SELECT id, parent_id FROM bench_partner
+        UNION
+            SELECT cycle.id, bench_partner.parent_id
+            FROM   bench_partner, cycle
+            WHERE  bench_partner.id = cycle.parent_id
+              AND  cycle.id != cycle.parent_id
+    )
+    SELECT id FROM cycle
+        WHERE id = parent_id AND id = %s
+"""
+
+hierarchy = load('hierarchy')
+
+
+def generate(chains, depth):
+    """Return ``{id: parent_id}`` of ``chains`` chains of ``depth`` nodes,
+    the first chain being closed on itself"""
+    parents = {}
+    for chain in range(chains):
+        first = chain * depth + 1
+        for node in range(first + 1, first + depth):
+            parents[node] = node - 1
+    parents[1] = depth
+    return parents
+
+
+def legacy_closure(parents):
+    """Every ``(node, ancestor)`` pair, as the previous query enumerated"""
+    pairs = set()
+    for node in parents:
+        ancestor = parents.get(node)
+        while ancestor is not None and (node, ancestor) not in pairs:
+            pairs.add((node, ancestor))
+            if ancestor == node:
+                break
+            ancestor = parents.get(ancestor)
+    return pairs
+
+
+def bench_sql(dsn, parents, repeat):
+    import psycopg2
+    cnx = psycopg2.connect(dsn)
+    cr = cnx.cursor()
+    cr.execute("CREATE TEMP TABLE bench_partner "
+               "(id integer PRIMARY KEY, parent_id integer)")
+    nodes = set(parents) | set(parents.itervalues())
+    cr.executemany("INSERT INTO bench_partner VALUES (%s, %s)",
+                   [(node, parents.get(node)) for node in nodes])
+    cr.execute("CREATE INDEX ON bench_partner (parent_id)")
+    cr.execute("ANALYZE bench_partner")
+    leaf = max(nodes)
+
+    def legacy():
+        cr.execute(LEGACY_QUERY, (leaf,))
+        cr.fetchall()
+
+    def walk():
+        hierarchy.has_cycle(cr, leaf, table='bench_partner')
+
+    def bulk():
+        hierarchy.find_cycles(cr, table='bench_partner')
+
+    for name, function in [('legacy recursive cte', legacy),
+                           ('ancestor walk', walk),
+                           ('bulk find_cycles', bulk)]:
+        best = min(timeit.repeat(function, number=1, repeat=repeat))
+        print('  %-22s %.4fs' % (name, best))
+    cnx.rollback()
+    cnx.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--chains', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dsn')
+    args = parser.parse_args()
+
+    parents = generate(args.chains, args.depth)
+    print('%d partners in %d chains of depth %d'
+          % (args.chains * args.depth, args.chains, args.depth))
+    for name, function in [('legacy closure', legacy_closure),
+                           ('find_cycles_in', hierarchy.find_cycles_in)]:
+        best = min(timeit.repeat(lambda: function(parents), number=1,
+                                 repeat=args.repeat))
+        print('  %-22s %.4fs' % (name, best))
+    assert hierarchy.find_cycles_in(parents) == [
+        [1] + range(args.depth, 1, -1)]
+
+    if args.dsn:
+        bench_sql(args.dsn, parents, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+Benchmark of the partner merge on a synthetic population of contacts.
+
+    python benchmarks/bench_merge.py -d DATABASE [--addons-path PATH]
+        [--partners 10000] [--duplicate-ratio 0.2] [--group-size 2]
+        [--depth 2] [--messages 3] [--attachments 1] [--custom-refs 2]
+        [--merge-samples 20] [--workers 1]
+        [--save RESULTS.json] [--compare BASELINE.json] [--tolerance 0.2]
+        [--keep]
+
+DATABASE must be a scratch database with base_partner_merge installed: the
+automatic merge commits, so the generated contacts are really merged. They
+are named ``bench-*`` and deleted at the end unless ``--keep`` is given.
+
+The population is made of ``--partners`` contacts, ``--duplicate-ratio`` of
+them sharing their email by groups of ``--group-size``. Every duplicate gets
+a chain of ``--depth`` descendants, ``--messages`` mail.message,
+``--attachments`` ir.attachment and ``--custom-refs`` rows of the table
+``bench_partner_ref``, which has a plain foreign key to res_partner.
+The rows are copied in SQL from templates created with the ORM, so every
+NOT NULL column of the installed modules is filled, and the population only
+depends on the parameters. ``--merge-samples`` groups are merged one by one
+with ``_merge`` and rolled back before the automatic merge of all groups;
+groups larger than ``base_partner_merge.max_partners`` fail.
+
+The timings are printed and can be saved as JSON. With ``--compare`` the
+run is compared to a saved one and the exit status is 1 when a timing is
+more than ``--tolerance`` slower.
+"""
+import argparse
+import json
+import sys
+import time
+from ast import literal_eval
+
+import openerp
+from openerp import SUPERUSER_ID
+
+WIZARD = 'base.partner.merge.automatic.wizard'
+
+
+def insert_copies(cr, table, template_id, sources, overrides):
+    """
+    Insert a copy of the row ``template_id`` of ``table`` for each row of
+    the SQL ``sources`` (aliased ``s``), the columns of ``overrides`` being
+    set to their SQL expression. Return the number of rows inserted.
+    """
+    cr.execute("""  SELECT column_name
+                      FROM information_schema.columns
+                     WHERE table_schema = current_schema()
+                       AND table_name = %s AND column_name != 'id'
+                  ORDER BY ordinal_position
+               """, (table,))
+    columns = [column for column, in cr.fetchall()]
+    cr.execute('INSERT INTO "%(table)s" (%(columns)s) '
+               'SELECT %(values)s FROM "%(table)s" as t, (%(sources)s) as s '
+               'WHERE t.id = %%s'
+               % {'table': table,
+                  'columns': ', '.join('"%s"' % column for column in columns),
+                  'values': ', '.join(overrides.get(column, 't."%s"' % column)
+                                      for column in columns),
+                  'sources': sources},
+               (template_id,))
+    return cr.rowcount
+
+
+def generate(cr, registry, args):
+    """Create the synthetic population, return the number of rows by table"""
+    partner_obj = registry['res.partner']
+    template_id = partner_obj.create(cr, SUPERUSER_ID,
+                                     {'name': 'bench-template'})
+    duplicates = int(args.partners * args.duplicate_ratio)
+    counts = {}
+
+    # contacts: the first ``duplicates`` ones share their email by groups
+    email = ("'bench' || CASE WHEN s.g < %d THEN s.g / %d ELSE s.g + %d END "
+             "|| '@example.com'" % (duplicates, args.group_size,
+                                    args.partners))
+    name = "'bench-' || s.g"
+    overrides = {
+        'name': name,
+        'email': email,
+        'parent_id': 'NULL',
+        'merge_name_key': "'bench ' || s.g",
+        'merge_email_key': email,
+        'create_date': ("now() at time zone 'UTC' - s.g * interval "
+                        "'1 second'"),
+    }
+    if 'display_name' in partner_obj._columns:
+        overrides['display_name'] = name
+    counts['res_partner'] = insert_copies(
+        cr, 'res_partner', template_id,
+        'SELECT generate_series(0, %d) as g' % (args.partners - 1),
+        overrides)
+
+    cr.execute("SELECT id FROM res_partner WHERE name = ANY(%s)",
+               (['bench-%d' % g for g in xrange(duplicates)],))
+    duplicate_ids = [partner_id for partner_id, in cr.fetchall()]
+
+    # hierarchies under the duplicates, one level at a time
+    parent_ids = duplicate_ids
+    for level in xrange(1, args.depth + 1):
+        if not parent_ids:
+            break
+        overrides = {
+            'name': "'bench-child-%d-' || s.id" % level,
+            'email': 'NULL',
+            'merge_name_key': 'NULL',
+            'merge_email_key': 'NULL',
+            'parent_id': 's.id',
+        }
+        counts['res_partner'] += insert_copies(
+            cr, 'res_partner', template_id,
+            'SELECT unnest(ARRAY[%s]::int[]) as id'
+            % ', '.join(map(str, parent_ids)), overrides)
+        cr.execute("SELECT id FROM res_partner WHERE name LIKE %s",
+                   ('bench-child-%d-%%' % level,))
+        parent_ids = [partner_id for partner_id, in cr.fetchall()]
+
+    sources = ('SELECT p.id, n FROM res_partner as p, '
+               'generate_series(1, %%d) as n WHERE p.id IN (%s)'
+               % ', '.join(map(str, duplicate_ids or [0])))
+    if args.messages:
+        message_id = registry['mail.message'].create(cr, SUPERUSER_ID, {
+            'model': 'res.partner',
+            'res_id': template_id,
+            'body': 'bench',
+        })
+        counts['mail_message'] = insert_copies(
+            cr, 'mail_message', message_id, sources % args.messages,
+            {'res_id': 's.id'})
+    if args.attachments:
+        attachment_id = registry['ir.attachment'].create(cr, SUPERUSER_ID, {
+            'name': 'bench.txt',
+            'res_model': 'res.partner',
+            'res_id': template_id,
+            'datas': 'YmVuY2g=',
+        })
+        counts['ir_attachment'] = insert_copies(
+            cr, 'ir_attachment', attachment_id, sources % args.attachments,
+            {'res_id': 's.id'})
+    if args.custom_refs:
+        cr.execute("""  INSERT INTO bench_partner_ref (partner_id, value)
+                        SELECT s.id, s.n FROM (%s) as s
+                   """ % (sources % args.custom_refs))
+        counts['bench_partner_ref'] = cr.rowcount
+
+    cr.execute("DELETE FROM mail_message WHERE model = 'res.partner' "
+               "AND res_id = %s", (template_id,))
+    cr.execute("DELETE FROM ir_attachment WHERE res_model = 'res.partner' "
+               "AND res_id = %s", (template_id,))
+    partner_obj.unlink(cr, SUPERUSER_ID, [template_id])
+    cr.execute("ANALYZE res_partner")
+    return counts
+
+
+def cleanup(cr):
+    cr.execute("SELECT id FROM res_partner WHERE name LIKE 'bench-%'")
+    partner_ids = [partner_id for partner_id, in cr.fetchall()] or [0]
+    cr.execute("DELETE FROM mail_message WHERE model = 'res.partner' "
+               "AND res_id = ANY(%s)", (partner_ids,))
+    cr.execute("DELETE FROM ir_attachment WHERE res_model = 'res.partner' "
+               "AND res_id = ANY(%s)", (partner_ids,))
+    cr.execute("DROP TABLE IF EXISTS bench_partner_ref")
+    # detach the hierarchies, then delete them at once
+    cr.execute("UPDATE res_partner SET parent_id = NULL "
+               "WHERE id = ANY(%s)", (partner_ids,))
+    cr.execute("DELETE FROM res_partner WHERE id = ANY(%s)", (partner_ids,))
+
+
+def timed(timings, label, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    timings[label] = time.time() - start
+    return result
+
+
+def run(registry, args):
+    wizard_obj = registry[WIZARD]
+    timings = {}
+    cr = registry.db.cursor()
+    try:
+        cleanup(cr)
+        cr.execute("""  CREATE TABLE bench_partner_ref (
+                            id serial PRIMARY KEY,
+                            partner_id integer NOT NULL
+                                REFERENCES res_partner ON DELETE CASCADE,
+                            value integer)
+                   """)
+        # the new foreign key must be seen by the merge
+        wizard_obj._schema_catalogue = None
+        counts = timed(timings, 'generate', generate, cr, registry, args)
+        cr.commit()
+
+        query = timed(timings, '_generate_query',
+                      wizard_obj._generate_query, ['email'], 0)
+
+        wizard_id = wizard_obj.create(cr, SUPERUSER_ID, {
+            'group_by_email': True,
+            'maximum_group': 0,
+            'merge_workers': args.workers,
+        })
+        timed(timings, '_process_query', wizard_obj._process_query,
+              cr, SUPERUSER_ID, [wizard_id], query)
+        wizard = wizard_obj.browse(cr, SUPERUSER_ID, wizard_id)
+        groups = [literal_eval(line.aggr_ids) for line in wizard.line_ids]
+        cr.rollback()
+
+        samples = groups[:args.merge_samples]
+        start = time.time()
+        for partner_ids in samples:
+            wizard_obj._merge(cr, SUPERUSER_ID, partner_ids)
+        elapsed = time.time() - start
+        timings['_merge (per group)'] = elapsed / len(samples) \
+            if samples else 0.0
+        cr.rollback()
+
+        wizard_id = wizard_obj.create(cr, SUPERUSER_ID, {
+            'group_by_email': True,
+            'maximum_group': 0,
+            'merge_workers': args.workers,
+        })
+        timed(timings, 'automatic_process_cb',
+              wizard_obj.automatic_process_cb, cr, SUPERUSER_ID, [wizard_id])
+        cr.commit()
+
+        if not args.keep:
+            cleanup(cr)
+            cr.commit()
+    finally:
+        cr.close()
+    return {'counts': counts, 'groups': len(groups), 'timings': timings,
+            'params': dict((key, value) for key, value
+                           in vars(args).iteritems()
+                           if key not in ('save', 'compare'))}
+
+
+def compare(result, baseline, tolerance):
+    """Print the timings against ``baseline``, return whether one regressed"""
+    regressed = False
+    print('%-24s %10s %10s %8s' % ('', 'baseline', 'current', 'ratio'))
+    for label, current in sorted(result['timings'].iteritems()):
+        previous = baseline['timings'].get(label)
+        if not previous:
+            print('%-24s %10s %9.3fs' % (label, '-', current))
+            continue
+        ratio = current / previous
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressed = True
+        print('%-24s %9.3fs %9.3fs %7.2fx%s' % (label, previous, current,
+                                                 ratio, flag))
+    if baseline.get('params') != result['params']:
+        print('warning: the runs have different parameters')
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--addons-path')
+    parser.add_argument('--partners', type=int, default=10000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--group-size', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--messages', type=int, default=3)
+    parser.add_argument('--attachments', type=int, default=1)
+    parser.add_argument('--custom-refs', type=int, default=2)
+    parser.add_argument('--merge-samples', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args(argv)
+
+    options = ['-d', args.database]
+    if args.addons_path:
+        options.append('--addons-path=%s' % args.addons_path)
+    openerp.tools.config.parse_config(options)
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+
+    result = run(registry, args)
+    print('%d groups of duplicates, rows generated: %s' % (
+        result['groups'], ', '.join('%s %d' % item for item
+                                    in sorted(result['counts'].iteritems()))))
+    for label, elapsed in sorted(result['timings'].iteritems()):
+        print('%-24s %9.3fs' % (label, elapsed))
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            if compare(result, json.load(baseline), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+
+class DisjointSet(object):
+    """Union-find over hashable items, used to cluster conflicting groups"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent != item:
+            root = item
+            while self.parent[root] != root:
+                root = self.parent[root]
+            # path compression
+            while self.parent[item] != root:
+                self.parent[item], item = root, self.parent[item]
+            parent = root
+        return parent
+
+    def union(self, item, *others):
+        root = self.find(item)
+        for other in others:
+            other_root = self.find(other)
+            if other_root != root:
+                self.parent[other_root] = root
+        return root
+
+    def groups(self):
+        result = {}
+        for item in self.parent:
+            result.setdefault(self.find(item), []).append(item)
+        return result.values()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+from email.utils import parseaddr
+import htmlentitydefs
+import re
+
+# Validation Library https://pypi.python.org/pypi/validate_email/1.1
+from .validate_email import VALID_ADDRESS_RE
+
+pattern = re.compile("&(\w+?);")
+separators = re.compile(r';|/|:')
+
+# Strict subset of the RFC 2822 addr-spec matching the usual addresses: an
+# address it accepts is always accepted by VALID_ADDRESS_RE, the others are
+# checked against the full expression.
+simple_address = re.compile(r'[\w%+-]+(?:\.[\w%+-]+)*'
+                            r'@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+\Z')
+
+# validity of the last addresses checked, emptied when full
+_valid_cache = {}
+_valid_cache_size = 10000
+
+
+# http://www.php2python.com/wiki/function.html-entity-decode/
+def html_entity_decode_char(m, defs=htmlentitydefs.entitydefs):
+    try:
+        return defs[m.group(1)]
+    except KeyError:
+        return m.group(0)
+
+
+def html_entity_decode(string):
+    if '&' not in string:
+        return string
+    return pattern.sub(html_entity_decode_char, string)
+
+
+def is_valid_email(email):
+    """
+    Same result as ``validate_email(email)`` without MX checks, using the
+    simple expression first and caching the answer of the full one.
+    """
+    if simple_address.match(email) is not None:
+        return True
+    try:
+        return _valid_cache[email]
+    except KeyError:
+        if len(_valid_cache) >= _valid_cache_size:
+            _valid_cache.clear()
+        valid = _valid_cache[email] = \
+            VALID_ADDRESS_RE.match(email) is not None
+        return valid
+
+
+def sanitize_email(partner_email):
+    assert isinstance(partner_email, basestring) and partner_email
+
+    if simple_address.match(partner_email) is not None:
+        # a single plain address, nothing to split, decode or unquote
+        return [partner_email.lower()]
+
+    result = separators.sub(',', html_entity_decode(partner_email))
+    emails = [parseaddr(email)[1]
+              for item in result.split(',')
+              for email in item.split()]
+
+    return [email.lower()
+            for email in emails
+            if is_valid_email(email)]
+
+
+def sanitize_emails(partner_emails):
+    """
+    Sanitize a list of raw email fields at once: return the list of the
+    addresses found in each of them, empty for empty fields. Identical
+    fields are only parsed once.
+    """
+    cache = {}
+    result = []
+    for partner_email in partner_emails:
+        if not partner_email:
+            result.append([])
+            continue
+        emails = cache.get(partner_email)
+        if emails is None:
+            emails = cache[partner_email] = sanitize_email(partner_email)
+        result.append(list(emails))
+    return result
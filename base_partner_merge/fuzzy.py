@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import collections
+import re
+import unicodedata
+
+from .disjoint_set import DisjointSet
+
+_non_alnum = re.compile(r'[\W_]+', re.UNICODE)
+
+# Blocking keys: SQL expressions on res_partner splitting the partners in
+# blocks, only partners of the same block are compared together. The
+# columns are prefixed with %(alias)s, use blocking_key_sql to get them.
+BLOCKING_KEYS = collections.OrderedDict([
+    ('name', "substr(replace(%(alias)smerge_name_key, ' ', ''), 1, 4)"),
+    ('email_domain', "split_part(%(alias)smerge_email_key, '@', 2)"),
+    ('zip', "upper(replace(%(alias)szip, ' ', ''))"),
+    ('vat_country', "substr(%(alias)smerge_vat_key, 1, 2)"),
+])
+
+# SQL expression sorting the partners of a block, close names are compared
+NAME_ORDER_SQL = 'merge_name_key'
+
+
+def blocking_key_sql(key, alias=None):
+    """
+    Return the SQL expression of the blocking ``key``, its columns
+    qualified with the table ``alias`` if any.
+    """
+    return BLOCKING_KEYS[key] % {'alias': '%s.' % alias if alias else ''}
+
+
+def normalize_name(name):
+    """
+    Lower-case ``name``, strip its accents and punctuation and collapse its
+    whitespaces, so "Acme S.A." and "ACME  SA" give the same result.
+    """
+    if not name:
+        return u''
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(char for char in name if not unicodedata.combining(char))
+    name = name.replace(u'.', u'')
+    return u' '.join(_non_alnum.sub(u' ', name.lower()).split())
+
+
+def jaro_winkler(first, second, prefix_scale=0.1):
+    """Return the Jaro-Winkler similarity of two strings, between 0 and 1"""
+    if first == second:
+        return 1.0
+    len1, len2 = len(first), len(second)
+    if not len1 or not len2:
+        return 0.0
+
+    distance = max(max(len1, len2) // 2 - 1, 0)
+    matched1 = [False] * len1
+    matched2 = [False] * len2
+    matches = 0
+    for i, char in enumerate(first):
+        for j in xrange(max(0, i - distance), min(i + distance + 1, len2)):
+            if not matched2[j] and second[j] == char:
+                matched1[i] = matched2[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+
+    transpositions = 0
+    j = 0
+    for i in xrange(len1):
+        if matched1[i]:
+            while not matched2[j]:
+                j += 1
+            if first[i] != second[j]:
+                transpositions += 1
+            j += 1
+
+    matches = float(matches)
+    jaro = (matches / len1 + matches / len2 +
+            (matches - transpositions / 2.0) / matches) / 3
+
+    prefix = 0
+    for char1, char2 in zip(first[:4], second[:4]):
+        if char1 != char2:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+
+def trigrams(text):
+    """Return the trigrams of each word of ``text``, as pg_trgm does"""
+    result = set()
+    for word in text.split():
+        word = u'  %s ' % word
+        result.update(word[i:i + 3] for i in xrange(len(word) - 2))
+    return result
+
+
+def trigram_similarity(first, second):
+    """Return the share of trigrams common to two strings, between 0 and 1"""
+    if first == second:
+        return 1.0
+    grams1, grams2 = trigrams(first), trigrams(second)
+    if not grams1 or not grams2:
+        return 0.0
+    common = len(grams1 & grams2)
+    return float(common) / (len(grams1) + len(grams2) - common)
+
+
+SCORERS = {
+    'jaro_winkler': jaro_winkler,
+    'trigram': trigram_similarity,
+}
+
+
+class FuzzyMatcher(object):
+    """
+    Cluster partners having similar names.
+
+    Rows ``(block, partner_id, name)`` are fed sorted by block then by name.
+    Within a block each partner is only scored against the ``window``
+    previous ones (sorted neighbourhood), so the number of comparisons grows
+    linearly with the number of partners even for huge blocks. Partners
+    scoring at least ``threshold`` are put in the same cluster, across all
+    the blocking passes.
+    """
+
+    def __init__(self, method='jaro_winkler', threshold=0.92, window=10):
+        self.scorer = SCORERS[method]
+        self.threshold = threshold
+        self.window = max(1, window)
+        self.clusters = DisjointSet()
+        self.comparisons = 0
+        self.reset()
+
+    def reset(self):
+        """Start a new blocking pass"""
+        self._block = None
+        self._previous = collections.deque(maxlen=self.window)
+
+    def feed(self, rows):
+        scorer, threshold = self.scorer, self.threshold
+        for block, partner_id, name in rows:
+            if block != self._block:
+                self._block = block
+                self._previous.clear()
+            name = normalize_name(name)
+            if not name:
+                continue
+            for other_id, other_name in self._previous:
+                self.comparisons += 1
+                if scorer(name, other_name) >= threshold:
+                    self.clusters.union(other_id, partner_id)
+            self._previous.append((partner_id, name))
+
+    def groups(self, max_size=None):
+        """
+        Return the clusters of at least two partners, sorted. Clusters of
+        more than ``max_size`` partners, which could not be merged at once,
+        are split in sorted slices of ``max_size`` partners at most.
+        """
+        groups = []
+        for group in self.clusters.groups():
+            group = sorted(group)
+            size = max_size or len(group)
+            groups.extend(group[index:index + size]
+                          for index in xrange(0, len(group), size))
+        return sorted(group for group in groups if len(group) > 1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import logging
+
+_logger = logging.getLogger('base.partner.merge')
+
+# deeper hierarchies are considered as cyclic by ``has_cycle``
+MAX_DEPTH = 1000
+
+ANCESTORS_QUERY = """
+    WITH RECURSIVE ancestors(id, path) AS (
+            SELECT "%(parent)s", ARRAY[id]
+              FROM "%(table)s"
+             WHERE id = %%(id)s AND "%(parent)s" IS NOT NULL
+        UNION ALL
+            SELECT t."%(parent)s", a.path || a.id
+              FROM ancestors as a
+              JOIN "%(table)s" as t ON t.id = a.id
+             WHERE t."%(parent)s" IS NOT NULL
+               AND a.id != ALL(a.path)
+               AND array_length(a.path, 1) < %%(max_depth)s
+    )
+    SELECT coalesce(bool_or(id = %%(id)s), false),
+           coalesce(max(array_length(path, 1)), 0)
+      FROM ancestors
+"""
+
+
+def has_cycle(cr, record_id, table='res_partner', parent='parent_id',
+              max_depth=MAX_DEPTH):
+    """
+    Return whether ``record_id`` is one of its own ancestors.
+
+    Only the ancestors of ``record_id`` are walked, one indexed lookup per
+    level, stopping on the first node visited twice or after ``max_depth``
+    levels, in which case the hierarchy is considered as cyclic.
+    """
+    cr.execute(ANCESTORS_QUERY % {'table': table, 'parent': parent},
+               {'id': record_id, 'max_depth': max_depth})
+    cycle, depth = cr.fetchone()
+    if not cycle and depth >= max_depth:
+        _logger.warning('%s %s has more than %d ancestors, considered as '
+                        'cyclic', table, record_id, max_depth)
+        return True
+    return cycle
+
+
+def find_cycles_in(parents):
+    """
+    Return the cycles of the ``{id: parent_id}`` mapping, as lists of ids
+    starting with the smallest one. Every node is visited once.
+    """
+    state = {}
+    cycles = []
+    for start in parents:
+        if start in state:
+            continue
+        path = []
+        node = start
+        while node is not None and node not in state:
+            state[node] = start
+            path.append(node)
+            node = parents.get(node)
+        if node is not None and state[node] == start:
+            # the walk started from ``start`` came back on itself
+            cycle = path[path.index(node):]
+            first = cycle.index(min(cycle))
+            cycles.append(cycle[first:] + cycle[:first])
+    return sorted(cycles)
+
+
+def find_cycles(cr, table='res_partner', parent='parent_id', size=100000):
+    """
+    Return the cycles of the hierarchy of ``table``, read in a single scan.
+    """
+    cr.execute('SELECT id, "%s" FROM "%s" WHERE "%s" IS NOT NULL'
+               % (parent, table, parent))
+    parents = {}
+    while True:
+        rows = cr.fetchmany(size)
+        if not rows:
+            break
+        parents.update(rows)
+    return find_cycles_in(parents)
+
+
+def break_cycles(cr, table='res_partner', parent='parent_id'):
+    """
+    Detach the smallest record of every cycle of the hierarchy of ``table``
+    from its parent and return the ids of the detached records.
+    """
+    ids = [cycle[0] for cycle in find_cycles(cr, table, parent)]
+    if ids:
+        cr.execute('UPDATE "%s" SET "%s" = NULL WHERE id IN %%s'
+                   % (table, parent), (tuple(ids),))
+        _logger.info('%d cycles removed from the hierarchy of %s: %r',
+                     len(ids), table, ids)
+    return ids
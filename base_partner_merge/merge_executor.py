@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import logging
+import Queue
+import random
+import threading
+import time
+
+from psycopg2 import OperationalError
+
+import openerp
+from openerp.osv.osv import (PG_CONCURRENCY_ERRORS_TO_RETRY,
+                             MAX_TRIES_ON_CONCURRENCY_FAILURE)
+
+_logger = logging.getLogger('base.partner.merge')
+
+
+def schedule_units(units, footprints):
+    """
+    Order ``units`` so that the units taken one after the other by the
+    workers, i.e. running at the same time, lock rows in different tables.
+
+    ``footprints`` gives for each unit its rows to lock per table. Units are
+    bucketed by the table in which they lock the most rows, then taken
+    round-robin from the buckets, the heaviest units of each bucket first.
+    """
+    buckets = {}
+    for unit, footprint in zip(units, footprints):
+        table = max(footprint, key=lambda name: (footprint[name], name)) \
+            if footprint else None
+        buckets.setdefault(table, []).append(
+            (sum(footprint.itervalues()), unit))
+    queues = sorted((sorted(bucket, key=lambda item: (-item[0], len(item[1]))
+                            ) for bucket in buckets.itervalues()),
+                    key=lambda bucket: -sum(item[0] for item in bucket))
+    ordered = []
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0)[1])
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+class MergeExecutor(object):
+    """
+    Merge groups of partners, each group in its own transaction.
+
+    ``merge`` is called as ``merge(cr, group)``. ``units`` are lists of
+    groups: groups of one unit are merged one after the other by the same
+    worker, distinct units must not touch the same rows so they can be
+    merged concurrently. With a single worker the caller's cursor is used
+    and committed after each group, otherwise every worker opens its own
+    cursor. Units are taken in the given order.
+
+    Every attempt sets ``lock_timeout`` (in milliseconds, if any) so that a
+    merge waiting on a lock held by live traffic gives up instead of
+    piling up. Groups failing on a lock timeout, a serialization failure or
+    a deadlock are retried after an exponential backoff, and once more in
+    a last serial pass when all their tries are spent. Other errors are
+    logged and the group is skipped after calling
+    ``on_failure(cr, group, error, elapsed)`` in a new transaction.
+    """
+
+    def __init__(self, cr, merge, workers=1, on_failure=None,
+                 max_tries=MAX_TRIES_ON_CONCURRENCY_FAILURE,
+                 lock_timeout=None, backoff=1.0, max_backoff=30.0):
+        self.cr = cr
+        self.merge = merge
+        self.on_failure = on_failure
+        self.workers = max(1, workers or 1)
+        self.max_tries = max_tries
+        if lock_timeout and cr._cnx.server_version < 90300:
+            _logger.warning('lock_timeout needs PostgreSQL 9.3, merges will '
+                            'wait on locks without limit')
+            lock_timeout = None
+        self.lock_timeout = lock_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.done = []
+        self.failed = []
+        self.deferred = []
+        self.retries = 0
+
+    def run(self, units):
+        start = time.time()
+        units = [unit for unit in units if unit]
+        if self.workers == 1 or len(units) <= 1:
+            for unit in units:
+                self._run_unit(self.cr, unit, savepoint=True)
+        else:
+            queue = Queue.Queue()
+            for unit in units:
+                queue.put(unit)
+            threads = [threading.Thread(target=self._worker,
+                                        args=(queue,),
+                                        name='partner.merge.%d' % index)
+                       for index in range(min(self.workers, len(units)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # the contention is over: give the groups which ran out of tries a
+        # last chance, one at a time
+        deferred, self.deferred = self.deferred, []
+        for group in deferred:
+            self._run_group(self.cr, group, savepoint=True, defer=False)
+        return self.summary(time.time() - start)
+
+    def _worker(self, queue):
+        dbname = self.cr.dbname
+        threading.current_thread().dbname = dbname
+        cr = openerp.sql_db.db_connect(dbname).cursor()
+        try:
+            while True:
+                try:
+                    unit = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                self._run_unit(cr, unit)
+        finally:
+            cr.close()
+
+    def _run_unit(self, cr, unit, savepoint=False):
+        for group in unit:
+            self._run_group(cr, group, savepoint=savepoint)
+
+    def _run_group(self, cr, group, savepoint=False, defer=True):
+        start = time.time()
+        for tries in range(1, self.max_tries + 1):
+            if savepoint:
+                cr.execute('SAVEPOINT partner_merge_group')
+            try:
+                if self.lock_timeout:
+                    cr.execute('SET LOCAL lock_timeout = %s',
+                               (int(self.lock_timeout),))
+                self.merge(cr, group)
+            except OperationalError, e:
+                self._rollback(cr, savepoint)
+                if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                    self._fail(cr, group, e, start)
+                    return False
+                if tries == self.max_tries:
+                    if defer:
+                        _logger.info('%s, merge of %r deferred to the end '
+                                     'of the run', e.pgcode, group)
+                        self._record(self.deferred, group)
+                    else:
+                        self._fail(cr, group, e, start)
+                    return False
+                with self.lock:
+                    self.retries += 1
+                wait = random.uniform(0.0, min(self.max_backoff,
+                                               self.backoff * 2 ** tries))
+                _logger.info('%s, retry %d/%d of the merge of %r in %.3fs',
+                             e.pgcode, tries, self.max_tries, group, wait)
+                time.sleep(wait)
+            except Exception, e:
+                self._rollback(cr, savepoint)
+                self._fail(cr, group, e, start)
+                return False
+            else:
+                cr.commit()
+                self._record(self.done, group)
+                return True
+
+    def _fail(self, cr, group, error, start):
+        _logger.exception('Merge of %r failed', group)
+        self._record(self.failed, group)
+        if self.on_failure is not None:
+            self.on_failure(cr, group, error, time.time() - start)
+            cr.commit()
+
+    def _rollback(self, cr, savepoint):
+        if savepoint:
+            cr.execute('ROLLBACK TO SAVEPOINT partner_merge_group')
+        else:
+            cr.rollback()
+
+    def _record(self, target, group):
+        with self.lock:
+            target.append(group)
+
+    def summary(self, elapsed):
+        return {
+            'workers': self.workers,
+            'merged': len(self.done),
+            'failed': len(self.failed),
+            'retries': self.retries,
+            'elapsed': elapsed,
+            'throughput': len(self.done) / elapsed if elapsed else 0.0,
+        }
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import json
+import logging
+import time
+from ast import literal_eval
+
+from openerp import SUPERUSER_ID, tools
+from openerp.osv import osv
+from openerp.osv import fields
+from openerp.tools.translate import _
+
+from .merge_executor import MergeExecutor, schedule_units
+from .merge_journal import add_int_array_column
+from .merge_stats import MergeStats
+
+_logger = logging.getLogger('base.partner.merge')
+
+
+class MergePartnerJob(osv.Model):
+    """
+    A deduplication run of the automatic merge. Unlike the lines of the
+    wizard, the candidate groups of a job are persistent: when a run dies
+    halfway, running the job again only merges the groups still pending.
+    """
+    _name = 'base.partner.merge.job'
+    _description = 'Partner Deduplication Job'
+    _order = 'id desc'
+
+    def _get_counts(self, cr, uid, ids, field_names, arg, context=None):
+        res = dict((id, {'group_count': 0,
+                         'pending_count': 0,
+                         'done_count': 0,
+                         'failed_count': 0,
+                         'skipped_count': 0}) for id in ids)
+        cr.execute("""  SELECT job_id, state, count(*)
+                          FROM base_partner_merge_job_group
+                         WHERE job_id IN %s
+                      GROUP BY job_id, state
+                   """, (tuple(ids),))
+        for job_id, state, count in cr.fetchall():
+            res[job_id]['group_count'] += count
+            res[job_id]['%s_count' % state] = count
+        return res
+
+    def get_stats(self, cr, uid, ids, context=None):
+        """
+        Return the merge stats of the groups merged by the jobs ``ids``,
+        summed per phase and per table: ``{'groups': n, 'phases': {name:
+        counters}, 'tables': {table: counters}}``, the counters being
+        ``{'time', 'statements', 'rows'}``.
+        """
+        res = {'groups': 0, 'phases': {}, 'tables': {}}
+        if not ids:
+            return res
+        cr.execute("""  SELECT stats
+                          FROM base_partner_merge_job_group
+                         WHERE job_id IN %s AND stats IS NOT NULL
+                   """, (tuple(ids),))
+        while True:
+            rows = cr.fetchmany(1000)
+            if not rows:
+                break
+            for stats, in rows:
+                stats = json.loads(stats)
+                res['groups'] += 1
+                phases = dict((phase['name'], phase)
+                              for phase in stats['phases'])
+                for key, items in [('phases', phases),
+                                   ('tables', stats['tables'])]:
+                    for name, counters in items.iteritems():
+                        total = res[key].setdefault(
+                            name, {'time': 0.0, 'statements': 0, 'rows': 0})
+                        for counter in total:
+                            total[counter] += counters[counter]
+        return res
+
+    def _get_stats_report(self, cr, uid, ids, field_name, arg, context=None):
+        res = {}
+        for job_id in ids:
+            stats = self.get_stats(cr, uid, [job_id], context=context)
+            if not stats['groups']:
+                res[job_id] = False
+                continue
+            lines = ['%d groups merged' % stats['groups'], '',
+                     'phases (time, statements, rows):']
+            for name, counters in sorted(stats['phases'].iteritems(),
+                                         key=lambda item: -item[1]['time']):
+                lines.append('  %s: %.3fs, %d, %d' % (
+                    name, counters['time'], counters['statements'],
+                    counters['rows']))
+            lines.extend(['', 'slowest tables (time, statements, rows):'])
+            for name, counters in sorted(stats['tables'].iteritems(),
+                                         key=lambda item: -item[1]['time']
+                                         )[:20]:
+                lines.append('  %s: %.3fs, %d, %d' % (
+                    name, counters['time'], counters['statements'],
+                    counters['rows']))
+            res[job_id] = '\n'.join(lines)
+        return res
+
+    _columns = {
+        'name': fields.char('Name', required=True),
+        'state': fields.selection([('draft', 'Draft'),
+                                   ('running', 'Running'),
+                                   ('done', 'Done'),
+                                   ('failed', 'Done with Errors')],
+                                  'State',
+                                  readonly=True,
+                                  required=True),
+        'merge_workers': fields.integer("Parallel Merges"),
+        'incremental': fields.boolean(
+            'Incremental',
+            readonly=True,
+            help="Groups are added by the incremental duplicate detection "
+                 "each time contacts are created or modified."),
+        'date_start': fields.datetime('Started', readonly=True),
+        'date_end': fields.datetime('Finished', readonly=True),
+        'group_ids': fields.one2many('base.partner.merge.job.group',
+                                     'job_id', 'Groups'),
+        'group_count': fields.function(_get_counts, type='integer',
+                                       string='Groups', multi='counts'),
+        'pending_count': fields.function(_get_counts, type='integer',
+                                         string='Pending', multi='counts'),
+        'done_count': fields.function(_get_counts, type='integer',
+                                      string='Merged', multi='counts'),
+        'failed_count': fields.function(_get_counts, type='integer',
+                                        string='Failed', multi='counts'),
+        'skipped_count': fields.function(_get_counts, type='integer',
+                                         string='Skipped', multi='counts'),
+        'stats_report': fields.function(_get_stats_report, type='text',
+                                        string='Merge Statistics'),
+    }
+
+    _defaults = {
+        'state': 'draft',
+        'merge_workers': 1,
+    }
+
+    def create_from_wizard(self, cr, uid, wizard_id, name, context=None):
+        """
+        Create a job holding the candidate groups currently stored in the
+        lines of the merge wizard ``wizard_id``.
+        """
+        wizard = self.pool['base.partner.merge.automatic.wizard'].browse(
+            cr, uid, wizard_id, context=context)
+        job_id = self.create(cr, uid, {
+            'name': name,
+            'merge_workers': wizard.merge_workers,
+        }, context=context)
+        cr.execute("""  INSERT INTO base_partner_merge_job_group
+                            (job_id, min_id, aggr_ids, member_ids, dst_id,
+                             state, create_uid, create_date, write_uid,
+                             write_date)
+                        SELECT %(job_id)s, min_id, aggr_ids, member_ids,
+                               dst_id, 'pending',
+                               %(uid)s, now() at time zone 'UTC',
+                               %(uid)s, now() at time zone 'UTC'
+                          FROM base_partner_merge_line
+                         WHERE wizard_id = %(wizard_id)s
+                      ORDER BY min_id
+                   """, {'job_id': job_id, 'uid': uid,
+                         'wizard_id': wizard_id})
+        return job_id
+
+    def retry_failed(self, cr, uid, ids, context=None):
+        group_obj = self.pool['base.partner.merge.job.group']
+        group_ids = group_obj.search(cr, uid, [('job_id', 'in', ids),
+                                               ('state', '=', 'failed')],
+                                     context=context)
+        group_obj.write(cr, uid, group_ids, {'state': 'pending',
+                                             'error': False},
+                        context=context)
+        return self.run(cr, uid, ids, context=context)
+
+    def review(self, cr, uid, ids, context=None):
+        """
+        Open the merge wizard on the pending groups of the job, claimed
+        one at a time, so that several reviewers can share the job.
+        """
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        wizard_id = wizard_obj.create(cr, uid, {'review_job_id': ids[0]},
+                                      context=context)
+        return wizard_obj._next_screen(
+            cr, uid, wizard_obj.browse(cr, uid, wizard_id, context=context),
+            context=context)
+
+    def run(self, cr, uid, ids, context=None):
+        """
+        Merge the pending groups of the jobs. Every group is merged and
+        flagged in its own transaction, so a job can be run again after an
+        interruption.
+        """
+        for job in self.browse(cr, uid, ids, context=context):
+            values = {'state': 'running', 'date_end': False}
+            if not job.date_start:
+                values['date_start'] = fields.datetime.now()
+            job.write(values)
+            # the groups must be visible to the cursors of the workers
+            cr.commit()
+
+            summary = self._run_groups(cr, uid, job, context=context)
+
+            job.refresh()
+            job.write({
+                'state': 'failed' if job.failed_count else 'done',
+                'date_end': fields.datetime.now(),
+            })
+            cr.commit()
+            _logger.info('job %s: merged %d groups (%d failed, %d retries) '
+                         'in %.1fs with %d workers: %.2f groups/s',
+                         job.id, summary['merged'], summary['failed'],
+                         summary['retries'], summary['elapsed'],
+                         summary['workers'], summary['throughput'])
+        return True
+
+    def _get_executor_options(self, cr, uid, context=None):
+        """
+        Return the lock timeout (ms) and retry backoff (s) of the merges,
+        read from the system parameters ``base_partner_merge.*``.
+        """
+        param_obj = self.pool['ir.config_parameter']
+
+        def get_param(key, default):
+            value = param_obj.get_param(cr, SUPERUSER_ID,
+                                        'base_partner_merge.%s' % key)
+            return float(value) if value else default
+
+        return {
+            'lock_timeout': int(get_param('lock_timeout', 5000)),
+            'backoff': get_param('retry_backoff', 1.0),
+            'max_backoff': get_param('max_retry_backoff', 30.0),
+        }
+
+    def _schedule_units(self, cr, uid, groups, units, context=None):
+        """
+        Order the ``units`` (lists of indexes in ``groups``) so that the
+        groups merged concurrently lock rows of different tables. The rows
+        are counted for chunks of about ``_candidate_chunk_size`` groups.
+        """
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        size = wizard_obj._candidate_chunk_size
+        footprints = []
+        start = 0
+        while start < len(units):
+            end = start
+            group_count = 0
+            while end < len(units) and (end == start or group_count < size):
+                group_count += len(units[end])
+                end += 1
+            chunk = units[start:end]
+            partner_ids = sorted(set(partner_id for unit in chunk
+                                     for index in unit
+                                     for partner_id in groups[index][1]))
+            counts = wizard_obj._count_references(cr, uid, partner_ids,
+                                                  context=context)
+            partner_rows = {}
+            for (table, column), partner_counts in counts.iteritems():
+                for partner_id, rows in partner_counts.iteritems():
+                    tables = partner_rows.setdefault(partner_id, {})
+                    tables[table] = tables.get(table, 0) + rows
+            for unit in chunk:
+                footprint = {}
+                for index in unit:
+                    for partner_id in groups[index][1]:
+                        for table, rows in partner_rows.get(
+                                partner_id, {}).iteritems():
+                            footprint[table] = footprint.get(table, 0) + rows
+                footprints.append(footprint)
+            start = end
+        return schedule_units(units, footprints)
+
+    def _run_groups(self, cr, uid, job, context=None):
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        group_obj = self.pool['base.partner.merge.job.group']
+        partner_obj = self.pool['res.partner']
+
+        # the groups claimed by a reviewer are left to them
+        cr.execute("""  SELECT id, member_ids, dst_id
+                          FROM base_partner_merge_job_group
+                         WHERE job_id = %s AND state = 'pending'
+                           AND (reviewer_id IS NULL
+                                OR date_claimed < now() at time zone 'UTC'
+                                                  - %s * interval '1 second')
+                      ORDER BY min_id
+                   """, (job.id, group_obj._claim_timeout))
+        groups = []
+        dst_ids = {}
+        for group_id, member_ids, dst_id in cr.fetchall():
+            groups.append((group_id, member_ids))
+            dst_ids[group_id] = dst_id
+
+        if job.merge_workers > 1:
+            units = wizard_obj._partition_groups(
+                cr, [partner_ids for group_id, partner_ids in groups])
+            units = [[groups[index] for index in unit]
+                     for unit in self._schedule_units(cr, uid, groups, units,
+                                                      context=context)]
+        else:
+            units = [[group] for group in groups]
+
+        def merge(merge_cr, group):
+            group_id, partner_ids = group
+            start = time.time()
+            stats = MergeStats()
+            dst_partner = None
+            if dst_ids.get(group_id):
+                # _merge ranks the group again if it is gone
+                dst_partner = partner_obj.browse(merge_cr, uid,
+                                                 dst_ids[group_id],
+                                                 context=context)
+            wizard_obj._merge(merge_cr, uid, partner_ids, dst_partner,
+                              context=dict(context or {}, merge_stats=stats))
+            values = stats.to_dict()
+            group_obj.write(merge_cr, uid, [group_id], {
+                'state': 'done',
+                'date_done': fields.datetime.now(),
+                'duration': time.time() - start,
+                'statement_count': values['statements'],
+                'row_count': values['rows'],
+                'stats': json.dumps(values, sort_keys=True),
+            }, context=context)
+
+        def on_failure(merge_cr, group, error, elapsed):
+            group_obj.write(merge_cr, uid, [group[0]], {
+                'state': 'failed',
+                'date_done': fields.datetime.now(),
+                'duration': elapsed,
+                'error': getattr(error, 'value', None) or tools.ustr(error),
+            }, context=context)
+
+        executor = MergeExecutor(cr, merge, workers=job.merge_workers,
+                                 on_failure=on_failure,
+                                 **self._get_executor_options(
+                                     cr, uid, context=context))
+        return executor.run(units)
+
+
+class MergePartnerJobGroup(osv.Model):
+    """
+    A candidate group of a job. The members are also kept as an
+    ``integer[]``, and a group can be claimed by a reviewer, who merges or
+    skips it from the wizard while the other reviewers get other groups.
+    """
+    _name = 'base.partner.merge.job.group'
+    _description = 'Partner Deduplication Job Group'
+    _order = 'min_id asc'
+
+    # seconds after which the groups claimed by a reviewer are released
+    _claim_timeout = 1800
+
+    _columns = {
+        'job_id': fields.many2one('base.partner.merge.job', 'Job',
+                                  required=True, ondelete='cascade',
+                                  select=True),
+        'min_id': fields.integer('MinID'),
+        'aggr_ids': fields.char('Ids', required=True),
+        # destination ranked when the candidates were computed
+        'dst_id': fields.integer('Destination', readonly=True),
+        'state': fields.selection([('pending', 'Pending'),
+                                   ('done', 'Merged'),
+                                   ('failed', 'Failed'),
+                                   ('skipped', 'Skipped')],
+                                  'State',
+                                  readonly=True,
+                                  required=True,
+                                  select=True),
+        'date_done': fields.datetime('Processed', readonly=True),
+        'duration': fields.float('Duration (s)', readonly=True),
+        'error': fields.text('Error', readonly=True),
+        'statement_count': fields.integer('Statements', readonly=True),
+        'row_count': fields.integer('Rows', readonly=True),
+        'stats': fields.text(
+            'Statistics', readonly=True,
+            help="Time, statements and rows of the merge per phase and per "
+                 "table, as JSON."),
+        'reviewer_id': fields.many2one('res.users', 'Reviewer',
+                                       readonly=True),
+        'date_claimed': fields.datetime('Claimed', readonly=True),
+        'review_summary': fields.text('Contacts', readonly=True),
+    }
+
+    _defaults = {
+        'state': 'pending',
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerJobGroup, self)._auto_init(cr,
+                                                           context=context)
+        add_int_array_column(cr, self._table, 'member_ids', gin=True)
+        # aggr_ids holds the repr of a list of ids
+        cr.execute("UPDATE base_partner_merge_job_group "
+                   "SET member_ids = translate(aggr_ids, '[]', '{}')::int[] "
+                   "WHERE member_ids IS NULL")
+        return res
+
+    def create(self, cr, uid, vals, context=None):
+        group_id = super(MergePartnerJobGroup, self).create(
+            cr, uid, vals, context=context)
+        cr.execute("UPDATE base_partner_merge_job_group SET member_ids = %s "
+                   "WHERE id = %s",
+                   (list(literal_eval(vals['aggr_ids'])), group_id))
+        return group_id
+
+    def claim(self, cr, uid, job_id, limit=1, context=None):
+        """
+        Claim for ``uid`` up to ``limit`` pending groups of the job
+        ``job_id``: the groups ``uid`` already claimed first, then the
+        free ones and the ones whose claim expired, by ``min_id``. The
+        rows locked by other reviewers claiming at the same time are
+        skipped. Return the ``(group_id, member_ids, dst_id,
+        review_summary)`` of the groups claimed, by ``min_id``.
+        """
+        skip_locked = ''
+        if cr._cnx.server_version >= 90500:
+            skip_locked = 'SKIP LOCKED'
+        cr.execute("""  UPDATE base_partner_merge_job_group as g
+                           SET reviewer_id = %%(uid)s,
+                               date_claimed = now() at time zone 'UTC'
+                          FROM (SELECT id
+                                  FROM base_partner_merge_job_group
+                                 WHERE job_id = %%(job_id)s
+                                   AND state = 'pending'
+                                   AND (reviewer_id IS NULL
+                                        OR reviewer_id = %%(uid)s
+                                        OR date_claimed
+                                           < now() at time zone 'UTC'
+                                             - %%(timeout)s
+                                               * interval '1 second')
+                              ORDER BY coalesce(reviewer_id = %%(uid)s, false)
+                                       DESC, min_id
+                                 LIMIT %%(limit)s
+                                   FOR UPDATE %s) as free
+                         WHERE g.id = free.id
+                     RETURNING g.id, g.member_ids, g.dst_id,
+                               g.review_summary, g.min_id
+                   """ % skip_locked,
+                   {'uid': uid, 'job_id': job_id, 'limit': limit,
+                    'timeout': self._claim_timeout})
+        return [row[:4] for row in sorted(cr.fetchall(),
+                                          key=lambda row: row[4])]
+
+    def check_claim(self, cr, uid, group_id, context=None):
+        """Lock the group ``group_id`` and check it is still pending and
+        claimed by ``uid``"""
+        cr.execute("SELECT reviewer_id, state "
+                   "FROM base_partner_merge_job_group "
+                   "WHERE id = %s FOR UPDATE", (group_id,))
+        row = cr.fetchone()
+        if not row or row[0] != uid or row[1] != 'pending':
+            raise osv.except_osv(
+                _('Error'),
+                _("This group of contacts has been processed or claimed by "
+                  "another reviewer meanwhile."))
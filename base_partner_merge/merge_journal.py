@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import logging
+from ast import literal_eval
+
+import psycopg2
+
+from openerp.osv import osv
+from openerp.osv import fields
+from openerp.tools.translate import _
+
+_logger = logging.getLogger('base.partner.merge')
+
+
+def add_int_array_column(cr, table, column, gin=False):
+    """Create the ``integer[]`` column ``column`` of ``table`` if missing,
+    with a GIN index for the containment operators if ``gin``"""
+    cr.execute("""  SELECT 1
+                      FROM information_schema.columns
+                     WHERE table_schema = current_schema()
+                       AND table_name = %s AND column_name = %s
+               """, (table, column))
+    if not cr.fetchone():
+        cr.execute('ALTER TABLE "%s" ADD COLUMN "%s" integer[]'
+                   % (table, column))
+    index = '%s_%s_index' % (table, column)
+    cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", (index,))
+    if gin and not cr.fetchone():
+        cr.execute('CREATE INDEX "%s" ON "%s" USING gin ("%s")'
+                   % (index, table, column))
+
+
+class MergePartnerJournal(osv.Model):
+    """
+    One entry per merge of partners: the merged (source) partner ids, the
+    destination partner id and, in the lines, the rows rewritten per table
+    with the source each row pointed to.
+
+    The source ids are an ``integer[]`` column indexed with GIN, so the
+    destination of a merged partner is found with a single index lookup.
+    The rows of the sources and the values of the destination changed by
+    the merge are kept as well, so that the merge can be undone.
+    """
+    _name = 'base.partner.merge.journal'
+    _description = 'Partner Merge Journal'
+    _order = 'id desc'
+    _rec_name = 'dst_id'
+
+    def _get_src_list(self, cr, uid, ids, field_name, arg, context=None):
+        cr.execute("SELECT id, array_to_string(src_ids, ', ') "
+                   "FROM base_partner_merge_journal WHERE id IN %s",
+                   (tuple(ids),))
+        return dict(cr.fetchall())
+
+    _columns = {
+        'dst_id': fields.integer('Destination Contact', required=True,
+                                 readonly=True, select=True),
+        'src_list': fields.function(_get_src_list, type='char',
+                                    string='Merged Contacts'),
+        'line_ids': fields.one2many('base.partner.merge.journal.line',
+                                    'journal_id', 'Rewritten Rows',
+                                    readonly=True),
+        'src_values': fields.text('Merged Contacts Values', readonly=True),
+        'dst_values': fields.text('Destination Previous Values',
+                                  readonly=True),
+        'date_unmerged': fields.datetime('Undone on', readonly=True),
+        'create_date': fields.datetime('Date', readonly=True),
+        'create_uid': fields.many2one('res.users', 'User', readonly=True),
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerJournal, self)._auto_init(cr, context=context)
+        add_int_array_column(cr, self._table, 'src_ids', gin=True)
+        return res
+
+    def snapshot(self, cr, uid, partner_ids, context=None):
+        """Return the rows of res_partner ``partner_ids`` by id, as dicts of
+        python literals"""
+        cr.execute("SELECT * FROM res_partner WHERE id IN %s",
+                   (tuple(partner_ids),))
+        return dict((row['id'], dict(
+            (name, str(value) if isinstance(value, buffer) else value)
+            for name, value in row.iteritems()))
+            for row in cr.dictfetchall())
+
+    def record(self, cr, uid, src_ids, dst_id, stats, snapshot=None,
+               context=None):
+        """
+        Journal the merge of the partners ``src_ids`` into ``dst_id`` with
+        the rows rewritten collected in the ``MergeStats`` ``stats``.
+        ``snapshot`` holds the rows of the partners taken before the merge.
+        """
+        src_values = dst_values = None
+        if snapshot:
+            wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+            before = snapshot[dst_id]
+            after = self.snapshot(cr, uid, [dst_id], context=context)[dst_id]
+            dst_values = repr(dict(
+                (name, before[name])
+                for name in wizard_obj._get_merge_value_fields(cr)
+                if before.get(name) != after.get(name)))
+            src_values = repr([snapshot[src_id] for src_id in sorted(src_ids)
+                               if src_id in snapshot])
+        cr.execute("""  INSERT INTO base_partner_merge_journal
+                            (dst_id, src_ids, src_values, dst_values,
+                             create_uid, create_date, write_uid, write_date)
+                        VALUES (%s, %s, %s, %s,
+                                %s, now() at time zone 'UTC',
+                                %s, now() at time zone 'UTC')
+                     RETURNING id
+                   """, (dst_id, sorted(src_ids), src_values, dst_values,
+                         uid, uid))
+        journal_id = cr.fetchone()[0]
+        if stats.rows:
+            query = ("INSERT INTO base_partner_merge_journal_line "
+                     "(journal_id, table_name, column_name, row_count, "
+                     "row_ids, old_ids) VALUES %s"
+                     % ', '.join(['(%s, %s, %s, %s, %s, %s)']
+                                 * len(stats.rows)))
+            params = []
+            for (table, column), count in sorted(stats.rows.iteritems()):
+                rows = sorted(stats.row_ids.get((table, column)) or [])
+                row_ids, old_ids = zip(*rows) if rows else (None, None)
+                params.extend([journal_id, table, column, count,
+                               row_ids and list(row_ids),
+                               old_ids and list(old_ids)])
+            cr.execute(query, params)
+        return journal_id
+
+    def unmerge(self, cr, uid, ids, context=None):
+        """
+        Undo the merges ``ids``, the most recent first: the source partners
+        are inserted back with their ids and values, the rows journaled are
+        pointed back at them with one statement per table and the values of
+        the destination changed by the merge are restored. The stored
+        fields of the restored partners and rows are recomputed.
+
+        The rows of relation tables (without ``id`` column) and the rows
+        deleted with the sources are not restored, a warning is logged for
+        them.
+        """
+        cr.execute("""  SELECT id, dst_id, src_ids, src_values, dst_values
+                          FROM base_partner_merge_journal
+                         WHERE id IN %s AND date_unmerged IS NULL
+                      ORDER BY id DESC
+                   """, (tuple(ids),))
+        entries = cr.fetchall()
+        for journal_id, dst_id, src_ids, src_values, dst_values in entries:
+            if not src_values:
+                raise osv.except_osv(
+                    _('Error'),
+                    _("The merge %d was journaled without the values of "
+                      "the contacts, it cannot be undone.") % journal_id)
+            cr.execute("SELECT id FROM res_partner WHERE id IN %s",
+                       (tuple(src_ids),))
+            if cr.fetchall():
+                raise osv.except_osv(
+                    _('Error'),
+                    _("The contacts %s of the merge %d exist, it cannot be "
+                      "undone.") % (src_ids, journal_id))
+
+            self._restore_partners(cr, uid, literal_eval(src_values),
+                                   context=context)
+            self._restore_rows(cr, uid, journal_id, dst_id, context=context)
+            self._recompute_stored_fields(cr, uid, 'res.partner', src_ids,
+                                          context=context)
+            dst_values = literal_eval(dst_values or '{}')
+            partner_obj = self.pool['res.partner']
+            if dst_values and partner_obj.exists(cr, uid, dst_id,
+                                                 context=context):
+                partner_obj.write(cr, uid, [dst_id], dst_values,
+                                  context=context)
+            cr.execute("UPDATE base_partner_merge_journal "
+                       "SET date_unmerged = now() at time zone 'UTC' "
+                       "WHERE id = %s", (journal_id,))
+            _logger.info('merge %d undone: partners %r restored from %d',
+                         journal_id, src_ids, dst_id)
+        return True
+
+    def _restore_partners(self, cr, uid, rows, context=None):
+        """Insert back the rows of res_partner ``rows``, in one statement"""
+        partner_obj = self.pool['res.partner']
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        existing = wizard_obj._get_schema_catalogue(cr).columns['res_partner']
+        names = [name for name in existing if name in rows[0]]
+        binaries = set(name for name in names
+                       if name in partner_obj._columns
+                       and partner_obj._columns[name]._type == 'binary')
+        params = []
+        for row in rows:
+            params.extend(psycopg2.Binary(row[name])
+                          if name in binaries and row[name] else row[name]
+                          for name in names)
+        cr.execute('INSERT INTO res_partner (%s) VALUES %s'
+                   % (', '.join('"%s"' % name for name in names),
+                      ', '.join(['(%s)' % ', '.join(['%s'] * len(names))]
+                                * len(rows))),
+                   params)
+
+    def _restore_rows(self, cr, uid, journal_id, dst_id, context=None):
+        """
+        Point the rows rewritten by the merge ``journal_id`` and still on
+        the destination ``dst_id`` back at their source, one statement per
+        table and column, and recompute the stored fields depending on them.
+        """
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        catalogue = wizard_obj._get_schema_catalogue(cr)
+        cr.execute("""  SELECT table_name, column_name, row_ids, old_ids
+                          FROM base_partner_merge_journal_line
+                         WHERE journal_id = %s
+                      ORDER BY table_name, column_name
+                   """, (journal_id,))
+        for table, column, row_ids, old_ids in cr.fetchall():
+            data_type = catalogue.column_types.get((table, column))
+            if data_type is None:
+                _logger.warning('merge %d: %s.%s does not exist anymore, '
+                                'rows not restored', journal_id, table,
+                                column)
+                continue
+            if (row_ids is None or old_ids is None
+                    or 'id' not in catalogue.columns[table]):
+                _logger.warning('merge %d: the rows of the relation table '
+                                '%s.%s cannot be restored', journal_id,
+                                table, column)
+                continue
+            if data_type == 'integer':
+                value, dst_value = '___old.src', dst_id
+            else:
+                value, dst_value = ("'res.partner,' || ___old.src",
+                                    'res.partner,%d' % dst_id)
+            cr.execute("""  UPDATE "%(table)s" as ___tu
+                               SET "%(column)s" = %(value)s
+                              FROM (SELECT unnest(%%s::int[]) as id,
+                                           unnest(%%s::int[]) as src)
+                                   as ___old
+                             WHERE ___tu.id = ___old.id
+                               AND ___tu."%(column)s" = %%s
+                         RETURNING ___tu.id
+                       """ % {'table': table, 'column': column,
+                              'value': value},
+                       (row_ids, old_ids, dst_value))
+            restored_ids = [row_id for row_id, in cr.fetchall()]
+            for model in self.pool.models.itervalues():
+                if model._table == table and column in model._columns:
+                    self._recompute_stored_fields(cr, uid, model._name,
+                                                  restored_ids, [column],
+                                                  context=context)
+
+    def _recompute_stored_fields(self, cr, uid, model, ids,
+                                 field_names=None, context=None):
+        """
+        Recompute the stored function fields depending on ``field_names``
+        (all the fields if ``None``) of the records ``ids`` of ``model``,
+        written in SQL
+        """
+        if not ids:
+            return
+        proxy = self.pool[model]
+        if field_names is None:
+            field_names = proxy._columns.keys()
+        for order, model_name, model_ids, names in sorted(
+                proxy._store_get_values(cr, uid, ids, field_names,
+                                        context=context)):
+            self.pool[model_name]._store_set_values(cr, uid, model_ids,
+                                                    names, context=context)
+
+    def resolve(self, cr, uid, partner_id, context=None):
+        """
+        Return the id of the partner ``partner_id`` has been merged into,
+        following successive merges, or ``partner_id`` if it was not.
+        """
+        seen = set([partner_id])
+        while True:
+            cr.execute("""  SELECT dst_id
+                              FROM base_partner_merge_journal
+                             WHERE src_ids @> ARRAY[%s]
+                               AND date_unmerged IS NULL
+                          ORDER BY id DESC
+                             LIMIT 1
+                       """, (partner_id,))
+            row = cr.fetchone()
+            if not row or row[0] in seen:
+                return partner_id
+            partner_id = row[0]
+            seen.add(partner_id)
+
+    def get_remapping(self, cr, uid, last_id=0, limit=None, context=None):
+        """
+        Return the ``(journal_id, src_id, dst_id)`` of the merges journaled
+        after the entry ``last_id``, oldest first, for the systems
+        synchronizing partner ids. Undone merges are left out. ``limit``
+        counts journal entries, so a page never stops in the middle of a
+        merge and the last journal id returned can be passed as ``last_id``.
+        """
+        cr.execute("""  SELECT id, unnest(src_ids), dst_id
+                          FROM (SELECT id, src_ids, dst_id
+                                  FROM base_partner_merge_journal
+                                 WHERE id > %s AND date_unmerged IS NULL
+                              ORDER BY id
+                                 LIMIT %s) as journal
+                      ORDER BY id
+                   """, (last_id, limit))
+        return cr.fetchall()
+
+
+class MergePartnerJournalLine(osv.Model):
+    _name = 'base.partner.merge.journal.line'
+    _description = 'Partner Merge Journal Line'
+    _log_access = False
+    _order = 'journal_id, table_name, column_name'
+
+    def _get_row_list(self, cr, uid, ids, field_name, arg, context=None):
+        cr.execute("SELECT id, array_to_string(row_ids, ', ') "
+                   "FROM base_partner_merge_journal_line WHERE id IN %s",
+                   (tuple(ids),))
+        return dict(cr.fetchall())
+
+    _columns = {
+        'journal_id': fields.many2one('base.partner.merge.journal',
+                                      'Journal Entry', required=True,
+                                      ondelete='cascade', select=True),
+        'table_name': fields.char('Table', required=True),
+        'column_name': fields.char('Column', required=True),
+        'row_count': fields.integer('Rows'),
+        'row_list': fields.function(_get_row_list, type='text',
+                                    string='Row Ids'),
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerJournalLine, self)._auto_init(
+            cr, context=context)
+        add_int_array_column(cr, self._table, 'row_ids')
+        add_int_array_column(cr, self._table, 'old_ids')
+        return res
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+
+class MergePlan(object):
+    """
+    Estimate of an automatic merge, collected without modifying anything:
+    the rows each group of partners would rewrite per ``(table, column)``.
+
+    Every group is merged in its own transaction, so the rows a group
+    rewrites are also the row locks held at once by that transaction.
+    """
+
+    def __init__(self):
+        self.groups = 0
+        self.partners = 0
+        self.skipped = 0
+        self.refused = 0
+        self.rows = {}
+        self.max_rows = {}
+        self.max_group_rows = 0
+
+    def add_group(self, partner_count, rows):
+        """Account for a group of ``partner_count`` partners rewriting
+        ``rows``, a dict ``{(table, column): rowcount}``"""
+        self.groups += 1
+        self.partners += partner_count
+        group_rows = {}
+        for (table, column), count in rows.iteritems():
+            if count <= 0:
+                continue
+            key = (table, column)
+            self.rows[key] = self.rows.get(key, 0) + count
+            group_rows[table] = group_rows.get(table, 0) + count
+        for table, count in group_rows.iteritems():
+            self.max_rows[table] = max(self.max_rows.get(table, 0), count)
+        self.max_group_rows = max(self.max_group_rows,
+                                  sum(group_rows.itervalues()))
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.itervalues())
+
+    def table_rows(self):
+        """Return ``[(table, rows)]``, the most rewritten tables first"""
+        tables = {}
+        for (table, column), count in self.rows.iteritems():
+            tables[table] = tables.get(table, 0) + count
+        return sorted(tables.iteritems(), key=lambda item: (-item[1], item[0]))
+
+    def estimate_runtime(self, group_cost, row_cost=0.0, workers=1):
+        """Return the estimated duration of the merge in seconds"""
+        workers = max(1, min(workers or 1, self.groups))
+        return ((self.groups * group_cost + self.total_rows * row_cost)
+                / workers)
+
+    def report(self, runtime, top=10):
+        lines = [
+            '%d groups, %d contacts (%d groups skipped, too many '
+            'contacts)' % (self.groups, self.partners, self.skipped),
+            '%d groups refused by the merge rules (emails, journal items)'
+            % self.refused,
+            '%d rows rewritten in %d tables' % (self.total_rows,
+                                                len(self.max_rows)),
+            'at most %d row locks held by one group' % self.max_group_rows,
+            'estimated runtime: %dh %02dm %02ds' % (runtime // 3600,
+                                                    runtime % 3600 // 60,
+                                                    runtime % 60),
+            '',
+            'hottest tables (rows, max rows locked by one group):',
+        ]
+        for table, count in self.table_rows()[:top]:
+            lines.append('  %s: %d, %d' % (table, count,
+                                           self.max_rows[table]))
+        lines.extend(['', 'rows per column:'])
+        for (table, column), count in sorted(self.rows.iteritems()):
+            lines.append('  %s.%s: %d' % (table, column, count))
+        return '\n'.join(lines)
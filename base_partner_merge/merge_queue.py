@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import logging
+
+from openerp import SUPERUSER_ID
+from openerp.osv import osv
+from openerp.osv import fields
+from openerp.tools.translate import _
+
+_logger = logging.getLogger('base.partner.merge')
+
+
+class MergePartnerQueue(osv.Model):
+    """
+    Partners created or modified since the last incremental duplicate
+    detection. The cron only compares these partners with the others, so its
+    cost follows the rate of writes instead of the size of res_partner.
+    """
+    _name = 'base.partner.merge.queue'
+    _description = 'Partner Duplicate Detection Queue'
+    _log_access = False
+
+    _columns = {
+        'partner_id': fields.integer('Contact', required=True),
+    }
+
+    # normalized keys of res.partner on which new duplicates are searched
+    _duplicate_keys = ['merge_email_key', 'merge_vat_key']
+
+    # flags of the wizard's _exclusion_models applied to the groups found,
+    # unless the parameter base_partner_merge.incremental_exclusions is set
+    _exclusion_flags = 'exclude_contact,exclude_journal_item'
+
+    def enqueue(self, cr, uid, partner_ids, context=None):
+        if not partner_ids:
+            return
+        cr.execute("INSERT INTO base_partner_merge_queue (partner_id) "
+                   "VALUES %s" % ', '.join(['(%s)'] * len(partner_ids)),
+                   list(partner_ids))
+
+    def _pop(self, cr, uid, limit, context=None):
+        cr.execute("""  DELETE FROM base_partner_merge_queue
+                         WHERE id IN (SELECT id
+                                        FROM base_partner_merge_queue
+                                    ORDER BY id
+                                       LIMIT %s)
+                     RETURNING partner_id
+                   """, (limit,))
+        return sorted(set(partner_id for partner_id, in cr.fetchall()))
+
+    def _get_incremental_job(self, cr, uid, context=None):
+        job_obj = self.pool['base.partner.merge.job']
+        job_ids = job_obj.search(cr, uid, [('incremental', '=', True)],
+                                 limit=1, context=context)
+        if job_ids:
+            return job_ids[0]
+        return job_obj.create(cr, uid, {
+            'name': _('Incremental duplicate detection'),
+            'incremental': True,
+        }, context=context)
+
+    def _find_groups(self, cr, uid, partner_ids, context=None):
+        """
+        Return the groups of partners sharing one of the duplicate keys
+        with ``partner_ids``, in one indexed query per key, without the
+        groups having a partner used in an excluded model.
+        """
+        groups = []
+        for key in self._duplicate_keys:
+            cr.execute("""  SELECT array_agg(p.id ORDER BY p.id)
+                              FROM res_partner as p
+                             WHERE p."%(key)s" IN (
+                                   SELECT q."%(key)s"
+                                     FROM res_partner as q
+                                    WHERE q.id = ANY(%%s)
+                                      AND q."%(key)s" IS NOT NULL)
+                          GROUP BY p."%(key)s"
+                            HAVING COUNT(*) >= 2
+                       """ % {'key': key}, (partner_ids,))
+            groups.extend(aggr_ids for aggr_ids, in cr.fetchall())
+
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        flags = self.pool['ir.config_parameter'].get_param(
+            cr, SUPERUSER_ID, 'base_partner_merge.incremental_exclusions',
+            self._exclusion_flags)
+        models = wizard_obj._get_exclusion_models(
+            set(flag.strip() for flag in (flags or '').split(',')))
+        return wizard_obj._filter_used_groups(cr, uid, groups, models,
+                                              context=context)
+
+    def process_queue(self, cr, uid, limit=10000, context=None):
+        """
+        Compare the queued partners with the existing ones and add the
+        groups of duplicates found to the incremental deduplication job.
+        Groups already in the job, whatever their state, are not added
+        again, and the pending groups overlapping a new group are replaced
+        by their union. Only the groups of the job sharing a partner with
+        the groups found are read. Return the number of partners checked.
+        """
+        partner_ids = self._pop(cr, uid, limit, context=context)
+        if not partner_ids:
+            return 0
+
+        groups = self._find_groups(cr, uid, partner_ids, context=context)
+        members_found = sorted(set(partner_id for aggr_ids in groups
+                                   for partner_id in aggr_ids))
+        group_obj = self.pool['base.partner.merge.job.group']
+        job_id = self._get_incremental_job(cr, uid, context=context)
+        cr.execute("""  SELECT id, member_ids, state
+                          FROM base_partner_merge_job_group
+                         WHERE job_id = %s AND member_ids && %s::int[]
+                   """, (job_id, members_found))
+        pending = {}
+        owner = {}
+        known = []
+        for group_id, member_ids, state in cr.fetchall():
+            if state == 'pending':
+                pending[group_id] = set(member_ids)
+                for partner_id in member_ids:
+                    owner[partner_id] = group_id
+            else:
+                known.append(set(member_ids))
+
+        created = 0
+        for aggr_ids in groups:
+            members = set(aggr_ids)
+            if any(members <= member_ids for member_ids in known):
+                continue
+            overlapping = set(owner[partner_id] for partner_id in members
+                              if partner_id in owner)
+            if any(members <= pending[group_id] for group_id in overlapping):
+                continue
+            for group_id in overlapping:
+                members |= pending.pop(group_id)
+            if overlapping:
+                group_obj.unlink(cr, uid, list(overlapping), context=context)
+            members = sorted(members)
+            group_id = group_obj.create(cr, uid, {
+                'job_id': job_id,
+                'min_id': members[0],
+                'aggr_ids': str(members),
+            }, context=context)
+            pending[group_id] = set(members)
+            for partner_id in members:
+                owner[partner_id] = group_id
+            created += 1
+
+        if created:
+            self.pool['base.partner.merge.job'].write(
+                cr, uid, [job_id], {'state': 'draft'}, context=context)
+        _logger.info('incremental duplicate detection: %d partners checked, '
+                     '%d groups added', len(partner_ids), created)
+        return len(partner_ids)
+
+    def _cron_process_queue(self, cr, uid, limit=10000, context=None):
+        while self.process_queue(cr, uid, limit=limit, context=context):
+            cr.commit()
+        return True
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+import time
+from contextlib import contextmanager
+
+
+class MergeStats(object):
+    """
+    Counters collected while merging one group of partners: the number of
+    SQL statements issued, the number of rows rewritten per
+    ``(table, column)`` and, for the tables having an ``id`` column, the
+    ``(row id, source partner id)`` of these rows.
+
+    The merge is divided in phases, each of them timed with ``phase``. The
+    wall time, statements and rows of a phase are also charged to the
+    tables it rewrote: the time elapsed since the previous counter update
+    goes to the table of the next one.
+    """
+
+    def __init__(self, clock=time.time):
+        self.statements = 0
+        self.rows = {}
+        self.row_ids = {}
+        self.phases = []
+        self.phase_stats = {}
+        self.table_stats = {}
+        self._clock = clock
+        self._mark = None
+
+    def add(self, table, column, rowcount, statements=1, ids=None):
+        self.statements += statements
+        table_stats = self.table_stats.setdefault(
+            table, {'time': 0.0, 'statements': 0, 'rows': 0})
+        table_stats['statements'] += statements
+        if self._mark is not None:
+            now = self._clock()
+            table_stats['time'] += now - self._mark
+            self._mark = now
+        if rowcount > 0:
+            table_stats['rows'] += rowcount
+            key = (table, column)
+            self.rows[key] = self.rows.get(key, 0) + rowcount
+            if ids:
+                self.row_ids.setdefault(key, []).extend(ids)
+
+    @contextmanager
+    def phase(self, name, cr=None):
+        """
+        Time the block as the phase ``name``. When the cursor ``cr`` is
+        given, every statement it executes is counted, not only the ones
+        passed to ``add``.
+        """
+        start = self._mark = self._clock()
+        statements, rows = self.statements, self.total_rows
+        sql_count = getattr(cr, 'sql_log_count', None)
+        try:
+            yield self
+        finally:
+            if sql_count is not None:
+                statements = cr.sql_log_count - sql_count
+            else:
+                statements = self.statements - statements
+            if name not in self.phase_stats:
+                self.phases.append(name)
+                self.phase_stats[name] = {'time': 0.0, 'statements': 0,
+                                          'rows': 0}
+            phase_stats = self.phase_stats[name]
+            phase_stats['time'] += self._clock() - start
+            phase_stats['statements'] += statements
+            phase_stats['rows'] += self.total_rows - rows
+            self._mark = None
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.itervalues())
+
+    @property
+    def total_time(self):
+        return sum(phase['time'] for phase in self.phase_stats.itervalues())
+
+    def to_dict(self):
+        """Return the counters as a dict of plain values, for logging and
+        storing them as JSON"""
+        statements = self.statements
+        if self.phases:
+            # the statements of the ORM calls are only counted per phase
+            statements = sum(phase['statements']
+                             for phase in self.phase_stats.itervalues())
+        return {
+            'statements': statements,
+            'rows': self.total_rows,
+            'time': self.total_time,
+            'phases': [dict(self.phase_stats[name], name=name)
+                       for name in self.phases],
+            'tables': self.table_stats,
+        }
+
+    def summary(self):
+        tables = ', '.join('%s.%s: %d' % (table, column, count)
+                           for (table, column), count
+                           in sorted(self.rows.iteritems()))
+        res = '%d statements, %d rows (%s)' % (self.statements,
+                                               self.total_rows,
+                                               tables or 'no rows')
+        if self.phases:
+            res += ' in %s' % ', '.join(
+                '%s %.3fs' % (name, self.phase_stats[name]['time'])
+                for name in self.phases)
+        return res
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+
+class SchemaCatalogue(object):
+    """
+    Snapshot of the pg_catalog information needed to merge partners: the
+    single-column foreign keys pointing at ``res_partner.id``, the ordered
+    column list of every table with the column types and its unique keys.
+
+    It is built once per registry by the merge wizard and thrown away when
+    the registry is reloaded, i.e. when modules are installed or upgraded.
+    """
+
+    def __init__(self, cr, table='res_partner'):
+        self.table = table
+        self.fk_edges = self._read_fk_edges(cr, table)
+        self.columns, self.column_types = self._read_columns(cr)
+        self.unique_constraints = self._read_unique_constraints(cr)
+
+    @staticmethod
+    def _read_fk_edges(cr, table):
+        cr.execute("""  SELECT cl1.relname as table,
+                               att1.attname as column
+                          FROM pg_constraint as con, pg_class as cl1,
+                               pg_class as cl2,
+                               pg_attribute as att1, pg_attribute as att2
+                         WHERE con.conrelid = cl1.oid
+                           AND con.confrelid = cl2.oid
+                           AND array_lower(con.conkey, 1) = 1
+                           AND con.conkey[1] = att1.attnum
+                           AND att1.attrelid = cl1.oid
+                           AND cl2.relname = %s
+                           AND att2.attname = 'id'
+                           AND array_lower(con.confkey, 1) = 1
+                           AND con.confkey[1] = att2.attnum
+                           AND att2.attrelid = cl2.oid
+                           AND con.contype = 'f'
+                      ORDER BY cl1.relname, att1.attname
+                   """, (table,))
+        return cr.fetchall()
+
+    @staticmethod
+    def _read_columns(cr):
+        cr.execute("""  SELECT table_name, column_name, data_type
+                          FROM information_schema.columns
+                         WHERE table_schema = current_schema()
+                      ORDER BY table_name, ordinal_position
+                   """)
+        columns = {}
+        column_types = {}
+        for table, column, data_type in cr.fetchall():
+            columns.setdefault(table, []).append(column)
+            column_types[(table, column)] = data_type
+        return columns, column_types
+
+    @staticmethod
+    def _read_unique_constraints(cr):
+        # unique indexes cover both UNIQUE and PRIMARY KEY constraints;
+        # partial and expression indexes cannot be used to deduplicate
+        cr.execute("""  SELECT cl.relname,
+                               array_agg(att.attname::text ORDER BY att.attnum)
+                          FROM pg_index as ind
+                          JOIN pg_class as cl ON cl.oid = ind.indrelid
+                          JOIN pg_namespace as ns ON ns.oid = cl.relnamespace
+                          JOIN pg_attribute as att
+                            ON att.attrelid = cl.oid
+                           AND att.attnum = ANY(ind.indkey)
+                         WHERE ind.indisunique
+                           AND ind.indpred IS NULL
+                           AND ind.indexprs IS NULL
+                           AND ns.nspname = current_schema()
+                      GROUP BY cl.relname, ind.indexrelid
+                   """)
+        constraints = {}
+        for table, columns in cr.fetchall():
+            constraints.setdefault(table, []).append(tuple(columns))
+        return constraints
+
+    def unique_key_for(self, table, column):
+        """
+        Return the other columns of the smallest unique key of ``table``
+        containing ``column``, or ``None`` if rewriting ``column`` cannot
+        collide. Two-column tables without declared key are relation tables
+        and are considered unique on both columns.
+        """
+        keys = [key for key in self.unique_constraints.get(table, ())
+                if column in key and len(key) > 1]
+        if keys:
+            key = min(keys, key=len)
+            return [name for name in key if name != column]
+        columns = self.columns.get(table, [])
+        if len(columns) == 2 and column in columns:
+            return [name for name in columns if name != column]
+        return None
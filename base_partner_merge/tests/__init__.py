@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from . import test_merge
+from . import test_fuzzy
+from . import test_email_tools
+from . import test_merge_executor
+from . import test_hierarchy
+from . import test_merge_stats
+
+checks = [
+    test_merge,
+    test_fuzzy,
+    test_email_tools,
+    test_merge_executor,
+    test_hierarchy,
+    test_merge_stats,
+]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import unittest2
+
+from openerp.addons.base_partner_merge.email_tools import (
+    is_valid_email, sanitize_email, sanitize_emails)
+from openerp.addons.base_partner_merge.validate_email import validate_email
+
+
+class TestEmailTools(unittest2.TestCase):
+
+    def test_00_is_valid_email(self):
+        for email in ['john@example.com', 'jane.doe+crm@mail.example.org',
+                      '"quoted name"@example.com', 'a..b@example.com',
+                      '.a@example.com', 'john@', 'not an address']:
+            self.assertEqual(is_valid_email(email), validate_email(email),
+                             email)
+
+    def test_01_sanitize_email(self):
+        self.assertEqual(sanitize_email('John@Example.com'),
+                         ['john@example.com'])
+        self.assertEqual(
+            sanitize_email('John &lt;john@example.com&gt;; jane@example.com'),
+            ['john@example.com', 'jane@example.com'])
+
+    def test_02_sanitize_emails(self):
+        self.assertEqual(
+            sanitize_emails(['a@example.com', False, 'a@example.com/b@x.org']),
+            [['a@example.com'], [], ['a@example.com', 'b@x.org']])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import unittest2
+
+from openerp.addons.base_partner_merge.fuzzy import (
+    FuzzyMatcher, jaro_winkler, normalize_name, trigram_similarity)
+
+
+class TestFuzzy(unittest2.TestCase):
+
+    def test_00_normalize_name(self):
+        self.assertEqual(normalize_name('Acme S.A.'), u'acme sa')
+        self.assertEqual(normalize_name(u'ACME  SA'), u'acme sa')
+        self.assertEqual(normalize_name(u'Élan-Vital'), u'elan vital')
+        self.assertEqual(normalize_name(False), u'')
+
+    def test_01_similarity(self):
+        self.assertAlmostEqual(jaro_winkler(u'martha', u'marhta'), 0.9611,
+                               places=4)
+        self.assertEqual(jaro_winkler(u'acme', u'acme'), 1.0)
+        self.assertEqual(jaro_winkler(u'acme', u''), 0.0)
+        self.assertEqual(trigram_similarity(u'acme sa', u'acme sa'), 1.0)
+        self.assertLess(trigram_similarity(u'acme sa', u'acme sarl'), 1.0)
+
+    def test_02_matcher_blocks(self):
+        """Only partners of the same block and window are compared"""
+        matcher = FuzzyMatcher(threshold=0.9, window=2)
+        matcher.feed([
+            ('acme', 1, 'ACME SA'),
+            ('acme', 2, 'Acme S.A.'),
+            ('acme', 3, 'Acme Services'),
+            ('acmi', 4, 'Acme SA'),
+        ])
+        self.assertEqual(matcher.groups(), [[1, 2]])
+        matcher.reset()
+        matcher.feed([
+            ('example.com', 2, 'Acme S.A.'),
+            ('example.com', 4, 'Acme SA'),
+        ])
+        self.assertEqual(matcher.groups(), [[1, 2, 4]])
+        self.assertEqual(matcher.groups(max_size=2), [[1, 2]])
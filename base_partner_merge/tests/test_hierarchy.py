@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import unittest2
+
+from openerp.addons.base_partner_merge.hierarchy import find_cycles_in
+
+
+class TestHierarchy(unittest2.TestCase):
+
+    def test_00_no_cycle(self):
+        self.assertEqual(find_cycles_in({2: 1, 3: 2, 4: 2, 5: 99}), [])
+
+    def test_01_cycles(self):
+        parents = {
+            1: 1,
+            3: 2, 2: 4, 4: 3,
+            5: 3, 6: 5,
+        }
+        self.assertEqual(find_cycles_in(parents), [[1], [2, 4, 3]])
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+from openerp import SUPERUSER_ID
+from openerp.osv import osv
+from openerp.tests import common
+
+from openerp.addons.base_partner_merge.hierarchy import has_cycle
+from openerp.addons.base_partner_merge.merge_executor import MergeExecutor
+
+
+class TestMerge(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMerge, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.partner = self.registry('res.partner')
+        self.wizard = self.registry('base.partner.merge.automatic.wizard')
+        self.company_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test Company',
+            'is_company': True,
+        })
+        self.partner_ids = [
+            self.partner.create(cr, uid, {'name': 'Merge Test %d' % index,
+                                          'email': 'merge@example.com'})
+            for index in range(3)
+        ]
+
+    def test_00_update_foreign_keys(self):
+        """Children of every source partner are moved to the destination"""
+        cr, uid = self.cr, self.uid
+        dst_id, src_ids = self.partner_ids[0], self.partner_ids[1:]
+        child_ids = [
+            self.partner.create(cr, uid, {'name': 'Child %d' % src_id,
+                                          'parent_id': src_id})
+            for src_id in src_ids
+        ]
+        self.wizard._merge(cr, SUPERUSER_ID, self.partner_ids,
+                           self.partner.browse(cr, uid, dst_id))
+
+        self.assertEqual(self.partner.exists(cr, uid, self.partner_ids),
+                         [dst_id])
+        for child in self.partner.browse(cr, uid, child_ids):
+            self.assertEqual(child.parent_id.id, dst_id)
+
+    def test_01_update_foreign_keys_stats(self):
+        """Tables without rows on the sources are skipped"""
+        cr, uid = self.cr, self.uid
+        dst_id, src_id = self.partner_ids[:2]
+        self.partner.create(cr, uid, {'name': 'Child',
+                                      'parent_id': src_id})
+        stats = self.wizard._update_foreign_keys(
+            cr, SUPERUSER_ID,
+            self.partner.browse(cr, uid, [src_id]),
+            self.partner.browse(cr, uid, dst_id))
+
+        self.assertEqual(stats.rows.get(('res_partner', 'parent_id')), 1)
+        self.assertEqual(stats.total_rows, sum(stats.rows.values()))
+        self.assertTrue(all(rows > 0 for rows in stats.rows.values()))
+
+    def test_02_plan(self):
+        """The plan counts the rows of the sources without merging them"""
+        cr, uid = self.cr, self.uid
+        self.partner.create(cr, uid, {'name': 'Child',
+                                      'parent_id': self.partner_ids[0]})
+        plan = self.wizard._plan_groups(cr, SUPERUSER_ID, [self.partner_ids])
+
+        self.assertEqual(plan.groups, 1)
+        self.assertEqual(plan.partners, 3)
+        self.assertEqual(plan.rows.get(('res_partner', 'parent_id')), 1)
+        self.assertEqual(plan.rows.get(('res_partner', 'id')), 3)
+        self.assertEqual(self.partner.exists(cr, uid, self.partner_ids),
+                         self.partner_ids)
+        self.assertIn('res_partner', plan.report(0.0))
+
+    def test_03_has_cycle(self):
+        """Only the ancestors of the partner are walked"""
+        cr, uid = self.cr, self.uid
+        parent_id, child_id = self.partner_ids[:2]
+        self.partner.write(cr, uid, [child_id], {'parent_id': parent_id})
+        self.assertFalse(has_cycle(cr, child_id))
+
+        cr.execute("UPDATE res_partner SET parent_id = %s WHERE id = %s",
+                   (child_id, parent_id))
+        self.assertTrue(has_cycle(cr, child_id))
+        self.assertTrue(has_cycle(cr, parent_id))
+        self.assertFalse(has_cycle(cr, self.partner_ids[2]))
+
+    def test_04_max_partners(self):
+        """The number of contacts merged together is configurable"""
+        cr, uid = self.cr, self.uid
+        param = self.registry('ir.config_parameter')
+        param.set_param(cr, uid, 'base_partner_merge.max_partners', '2')
+        self.assertRaises(osv.except_osv, self.wizard._merge,
+                          cr, SUPERUSER_ID, self.partner_ids)
+
+        param.set_param(cr, uid, 'base_partner_merge.max_partners', '0')
+        self.partner.create(cr, uid, {'name': 'Child',
+                                      'parent_id': self.partner_ids[1]})
+        dst = self.partner.browse(cr, uid, self.partner_ids[0])
+        self.wizard._merge(cr, SUPERUSER_ID, self.partner_ids, dst)
+        self.assertEqual(self.partner.exists(cr, uid, self.partner_ids),
+                         [dst.id])
+        dst.refresh()
+        self.assertIn('<li>res_partner: ', dst.message_ids[0].body)
+
+    def test_05_merged_values(self):
+        """Only the values differing from the destination are written"""
+        cr, uid = self.cr, self.uid
+        src_id, dst_id = self.partner_ids[:2]
+        self.partner.write(cr, uid, [src_id], {'phone': '+32 2 123 45 67',
+                                               'comment': 'Source'})
+        self.partner.write(cr, uid, [dst_id], {'comment': 'Destination'})
+
+        values = self.wizard._get_merged_values(cr, uid, [src_id, dst_id])
+        self.assertEqual(values, {'phone': '+32 2 123 45 67'})
+
+        self.wizard._merge_value_strategies = {'comment': 'concat'}
+        try:
+            values = self.wizard._get_merged_values(cr, uid,
+                                                    [src_id, dst_id])
+        finally:
+            del self.wizard._merge_value_strategies
+        self.assertEqual(values['comment'], 'Source\n\nDestination')
+
+    def test_06_journal(self):
+        """Merges are journaled with the rows they rewrote"""
+        cr, uid = self.cr, self.uid
+        journal = self.registry('base.partner.merge.journal')
+        dst_id, src_id = self.partner_ids[:2]
+        child_id = self.partner.create(cr, uid, {'name': 'Child',
+                                                 'parent_id': src_id})
+        self.wizard._merge(cr, SUPERUSER_ID, [src_id, dst_id],
+                           self.partner.browse(cr, uid, dst_id))
+
+        self.assertEqual(journal.resolve(cr, uid, src_id), dst_id)
+        self.assertEqual(journal.resolve(cr, uid, dst_id), dst_id)
+        journal_id, = journal.search(cr, uid, [('dst_id', '=', dst_id)])
+        cr.execute("SELECT row_ids FROM base_partner_merge_journal_line "
+                   "WHERE journal_id = %s AND table_name = 'res_partner' "
+                   "AND column_name = 'parent_id'", (journal_id,))
+        self.assertEqual(cr.fetchone()[0], [child_id])
+        self.assertIn((journal_id, src_id, dst_id),
+                      journal.get_remapping(cr, uid, journal_id - 1))
+
+    def test_06_journal_remapping_limit(self):
+        """The remapping is paged by journal entries, not by sources"""
+        cr, uid = self.cr, self.uid
+        journal = self.registry('base.partner.merge.journal')
+        dst_id, src_ids = self.partner_ids[0], self.partner_ids[1:]
+        self.wizard._merge(cr, SUPERUSER_ID, self.partner_ids,
+                           self.partner.browse(cr, uid, dst_id))
+
+        journal_id, = journal.search(cr, uid, [('dst_id', '=', dst_id)])
+        self.assertEqual(
+            sorted(journal.get_remapping(cr, uid, journal_id - 1, limit=1)),
+            [(journal_id, src_id, dst_id) for src_id in sorted(src_ids)])
+
+    def test_07_unmerge(self):
+        """Undoing a merge restores the sources and their rows"""
+        cr, uid = self.cr, self.uid
+        journal = self.registry('base.partner.merge.journal')
+        dst_id, src_id = self.partner_ids[:2]
+        self.partner.write(cr, uid, [src_id], {'phone': '0123456789'})
+        child_id = self.partner.create(cr, uid, {'name': 'Child',
+                                                 'parent_id': src_id})
+        self.wizard._merge(cr, SUPERUSER_ID, [src_id, dst_id],
+                           self.partner.browse(cr, uid, dst_id))
+        journal_id, = journal.search(cr, uid, [('dst_id', '=', dst_id)])
+
+        journal.unmerge(cr, uid, [journal_id])
+
+        src, dst, child = self.partner.browse(cr, uid,
+                                              [src_id, dst_id, child_id])
+        self.assertEqual(src.name, 'Merge Test 1')
+        self.assertEqual(src.phone, '0123456789')
+        self.assertFalse(dst.phone)
+        self.assertEqual(child.parent_id.id, src_id)
+        self.assertEqual(child.commercial_partner_id.id, src_id)
+        self.assertEqual(src.merge_email_key, 'merge@example.com')
+        self.assertEqual(journal.resolve(cr, uid, src_id), src_id)
+
+    def test_08_used_partners(self):
+        """Groups with a partner used in an excluded model are filtered"""
+        cr, uid = self.cr, self.uid
+        user = self.registry('res.users').browse(cr, uid, uid)
+        models = {'res.users': 'partner_id'}
+        groups = [[self.partner_ids[0], user.partner_id.id],
+                  self.partner_ids[1:]]
+        self.assertTrue(self.wizard._partner_use_in(cr, uid, groups[0],
+                                                    models))
+        self.assertFalse(self.wizard._partner_use_in(cr, uid, groups[1],
+                                                     models))
+        self.assertEqual(self.wizard._filter_used_groups(cr, uid, groups,
+                                                         models),
+                         [groups[1]])
+
+    def test_09_check_merge_groups(self):
+        """The rules of _merge are evaluated for several groups at once"""
+        cr, uid = self.cr, self.uid
+        user_id = self.registry('res.users').create(cr, uid, {
+            'name': 'Merge Test User',
+            'login': 'merge_test_user',
+        })
+        other_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test Other',
+            'email': 'other@example.com',
+        })
+        groups = [(self.partner_ids[0], self.partner_ids[1:]),
+                  (self.partner_ids[0], [other_id])]
+        errors = self.wizard._check_merge_groups(cr, user_id, groups)
+        self.assertIsNone(errors[0])
+        self.assertIn('same email', errors[1])
+        self.assertEqual(self.wizard._check_merge_groups(cr, uid, groups),
+                         [None, None])
+        with self.assertRaises(osv.except_osv):
+            self.wizard._merge(cr, user_id,
+                               [self.partner_ids[0], other_id])
+
+    def test_10_rank_partners(self):
+        """The destination is ranked in SQL by the configured signals"""
+        cr, uid = self.cr, self.uid
+        self.assertEqual(
+            self.wizard._get_ordered_partner(cr, uid, self.partner_ids)[-1].id,
+            self.partner_ids[-1])
+        self.partner.write(cr, uid, [self.partner_ids[0]], {'active': False})
+        self.assertEqual(self.wizard._rank_partners(cr, [self.partner_ids]),
+                         [[self.partner_ids[0], self.partner_ids[2],
+                           self.partner_ids[1]]])
+        self.registry('ir.config_parameter').set_param(
+            cr, uid, 'base_partner_merge.destination_ranking', 'active')
+        self.assertEqual(
+            self.wizard._rank_partners(cr, [self.partner_ids[:2], [0]]),
+            [[self.partner_ids[1], self.partner_ids[0]], []])
+
+    def test_11_review_claim(self):
+        """A group claimed by a reviewer is not given to another one"""
+        cr, uid = self.cr, self.uid
+        group_obj = self.registry('base.partner.merge.job.group')
+        job_id = self.registry('base.partner.merge.job').create(
+            cr, uid, {'name': 'Merge Test Review'})
+        group_id = group_obj.create(cr, uid, {
+            'job_id': job_id,
+            'min_id': self.partner_ids[0],
+            'aggr_ids': str(self.partner_ids),
+        })
+        user_id = self.registry('res.users').create(cr, uid, {
+            'name': 'Merge Test Reviewer',
+            'login': 'merge_test_reviewer',
+        })
+
+        self.assertEqual(group_obj.claim(cr, uid, job_id),
+                         [(group_id, self.partner_ids, None, None)])
+        self.assertEqual(group_obj.claim(cr, user_id, job_id), [])
+        with self.assertRaises(osv.except_osv):
+            group_obj.check_claim(cr, user_id, group_id)
+
+        context = {'partner_merge_no_prefetch': True}
+        wizard_id = self.wizard.create(cr, uid, {'review_job_id': job_id})
+        wizard = self.wizard.browse(cr, uid, wizard_id)
+        self.wizard._next_screen(cr, uid, wizard, context=context)
+        wizard.refresh()
+        self.assertEqual(wizard.review_group_id.id, group_id)
+        self.assertEqual(sorted(partner.id for partner
+                                in wizard.partner_ids), self.partner_ids)
+        self.assertIn('Merge Test 1', wizard.review_summary)
+        self.wizard.next_cb(cr, uid, [wizard_id], context=context)
+        self.assertEqual(group_obj.browse(cr, uid, group_id).state,
+                         'skipped')
+
+    def test_12_lock_timeout_retried(self):
+        """A lock timeout in the rewrite of a foreign key is retried"""
+        cr, uid = self.cr, self.uid
+        if cr._cnx.server_version < 90300:
+            self.skipTest('lock_timeout needs PostgreSQL 9.3')
+        # the destination must be committed to be locked by another cursor
+        dst_id = self.registry('ir.model.data').get_object_reference(
+            cr, uid, 'base', 'main_partner')[1]
+        src_id = self.partner_ids[0]
+        self.partner.create(cr, uid, {'name': 'Merge Test Child',
+                                      'parent_id': src_id})
+
+        def merge(merge_cr, group):
+            # moving the child takes a key share lock on the destination
+            self.wizard._update_foreign_keys(
+                merge_cr, uid, self.partner.browse(merge_cr, uid, [src_id]),
+                self.partner.browse(merge_cr, uid, dst_id))
+
+        executor = MergeExecutor(cr, merge, max_tries=2, lock_timeout=100,
+                                 backoff=0.0)
+        other_cr = self.registry.db.cursor()
+        try:
+            other_cr.execute("SELECT id FROM res_partner WHERE id = %s "
+                             "FOR UPDATE", (dst_id,))
+            self.assertFalse(executor._run_group(cr, (src_id,),
+                                                 savepoint=True))
+        finally:
+            other_cr.rollback()
+            other_cr.close()
+        self.assertEqual(executor.retries, 1)
+        self.assertEqual(executor.deferred, [(src_id,)])
+        self.assertEqual(executor.failed, [])
+
+    def test_13_queue_exclusions(self):
+        """The incremental detection skips the contacts of users"""
+        cr, uid = self.cr, self.uid
+        queue = self.registry('base.partner.merge.queue')
+        user = self.registry('res.users').browse(cr, uid, [
+            self.registry('res.users').create(cr, uid, {
+                'name': 'Merge Test User',
+                'login': 'merge_test_queue_user',
+                'email': 'merge-user@example.com',
+            })])[0]
+        partner_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test User Duplicate',
+            'email': 'merge-user@example.com',
+        })
+        self.assertEqual(queue._find_groups(cr, uid, [partner_id]), [])
+        self.registry('ir.config_parameter').set_param(
+            cr, uid, 'base_partner_merge.incremental_exclusions', '')
+        self.assertEqual(queue._find_groups(cr, uid, [partner_id]),
+                         [sorted([user.partner_id.id, partner_id])])
+
+    def test_14_queue_known_groups(self):
+        """The incremental detection does not recreate a skipped group"""
+        cr, uid = self.cr, self.uid
+        queue = self.registry('base.partner.merge.queue')
+        group_obj = self.registry('base.partner.merge.job.group')
+        partner_ids = sorted(
+            self.partner.create(cr, uid, {
+                'name': 'Merge Test Queue %d' % index,
+                'email': 'merge-queue@example.com',
+            }) for index in range(2))
+        queue.process_queue(cr, uid)
+        group_ids = group_obj.search(cr, uid, [('min_id', '=',
+                                                partner_ids[0])])
+        self.assertEqual(len(group_ids), 1)
+        group_obj.write(cr, uid, group_ids, {'state': 'skipped'})
+
+        queue.enqueue(cr, uid, partner_ids)
+        queue.process_queue(cr, uid)
+        self.assertEqual(group_obj.search(cr, uid, [('min_id', '=',
+                                                     partner_ids[0])]),
+                         group_ids)
+
+    def test_15_clean_emails(self):
+        """Extra addresses are split off through the ORM create"""
+        cr, uid = self.cr, self.uid
+        partner_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test Emails',
+            'email': 'First@Example.com, second@example.com',
+        })
+        self.wizard.clean_emails(cr, uid)
+
+        self.assertEqual(self.partner.browse(cr, uid, partner_id).email,
+                         'first@example.com')
+        copy_ids = self.partner.search(cr, uid, [
+            ('email', '=', 'second@example.com')])
+        self.assertEqual(len(copy_ids), 1)
+        cr.execute("SELECT 1 FROM base_partner_merge_queue "
+                   "WHERE partner_id = %s", (copy_ids[0],))
+        self.assertTrue(cr.fetchone())
+
+    def test_16_auto_parent_mixed_case(self):
+        """Email domains are compared on the lower-cased merge_email_key"""
+        cr, uid = self.cr, self.uid
+        if ('grade_id' not in self.partner._columns
+                or self.registry.get('account.invoice') is None):
+            self.skipTest('needs crm_partner_assign and account')
+        grade_id = self.registry('res.partner.grade').create(cr, uid, {
+            'name': 'Merge Test Grade',
+        })
+        company_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test Domain',
+            'is_company': True,
+            'grade_id': grade_id,
+            'email': 'Info@Merge-Domain.example.com',
+        })
+        contact_id = self.partner.create(cr, uid, {
+            'name': 'Merge Test Domain Contact',
+            'email': 'contact@MERGE-DOMAIN.example.com',
+        })
+        self.wizard.auto_set_parent_id(cr, uid, [])
+
+        self.assertEqual(
+            self.partner.browse(cr, uid, contact_id).parent_id.id,
+            company_id)
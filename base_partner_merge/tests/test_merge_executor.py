@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import unittest2
+
+from openerp.addons.base_partner_merge.disjoint_set import DisjointSet
+from openerp.addons.base_partner_merge.merge_executor import schedule_units
+
+
+class TestMergeExecutor(unittest2.TestCase):
+
+    def test_00_disjoint_set(self):
+        clusters = DisjointSet()
+        clusters.union(1, 2)
+        clusters.union(3, 4)
+        clusters.union(2, 4)
+        clusters.find(5)
+        self.assertEqual(sorted(sorted(group) for group in clusters.groups()),
+                         [[1, 2, 3, 4], [5]])
+
+    def test_01_schedule_units(self):
+        """Consecutive units lock rows of different tables"""
+        units = [[0], [1], [2], [3], [4]]
+        footprints = [
+            {'account_move_line': 10},
+            {'account_move_line': 50, 'mail_message': 2},
+            {'mail_message': 30},
+            {},
+            {'mail_message': 5},
+        ]
+        self.assertEqual(schedule_units(units, footprints),
+                         [[1], [2], [3], [0], [4]])
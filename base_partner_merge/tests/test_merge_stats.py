@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import unittest2
+
+from openerp.addons.base_partner_merge.merge_stats import MergeStats
+
+
+class FakeCursor(object):
+    sql_log_count = 0
+
+
+class TestMergeStats(unittest2.TestCase):
+
+    def test_00_phases(self):
+        """Time, statements and rows are charged to phases and tables"""
+        ticks = iter([0.0, 1.0, 3.0, 3.5, 10.0, 12.0, 12.0])
+        stats = MergeStats(clock=lambda: next(ticks))
+        with stats.phase('update_foreign_keys'):
+            stats.add('mail_message', 'res_id', 5, statements=2)
+            stats.add('account_invoice', 'partner_id', 1)
+        cr = FakeCursor()
+        with stats.phase('unlink', cr):
+            cr.sql_log_count += 4
+            stats.add('res_partner', 'id', 1, statements=0)
+
+        self.assertEqual(stats.phases, ['update_foreign_keys', 'unlink'])
+        self.assertEqual(stats.phase_stats['update_foreign_keys'],
+                         {'time': 3.5, 'statements': 3, 'rows': 6})
+        self.assertEqual(stats.phase_stats['unlink'],
+                         {'time': 2.0, 'statements': 4, 'rows': 1})
+        self.assertEqual(stats.table_stats['mail_message'],
+                         {'time': 1.0, 'statements': 2, 'rows': 5})
+        self.assertEqual(stats.table_stats['account_invoice'],
+                         {'time': 2.0, 'statements': 1, 'rows': 1})
+        self.assertEqual(stats.table_stats['res_partner']['time'], 2.0)
+        values = stats.to_dict()
+        self.assertEqual((values['statements'], values['rows'],
+                          values['time']), (7, 7, 5.5))
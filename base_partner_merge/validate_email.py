@@ -80,6 +80,7 @@ ADDR_SPEC = LOCAL_PART + r'@' + DOMAIN               # see 3.4.1
 
 # A valid address will match exactly the 3.4.1 addr-spec.
 VALID_ADDRESS_REGEXP = '^' + ADDR_SPEC + '$'
+VALID_ADDRESS_RE = re.compile(VALID_ADDRESS_REGEXP)
 
 def validate_email(email, check_mx=False,verify=False):
 
@@ -91,7 +92,7 @@ def validate_email(email, check_mx=False,verify=False):
     general this should correctly identify any email address likely
     to be in use as of 2011."""
     try:
-        assert re.match(VALID_ADDRESS_REGEXP, email) is not None
+        assert VALID_ADDRESS_RE.match(email) is not None
         check_mx |= verify
         if check_mx:
             if not DNS: raise Exception('For check the mx records or check if the email exists you must have installed pyDNS python package')